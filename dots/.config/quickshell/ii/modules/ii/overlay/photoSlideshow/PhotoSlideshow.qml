@@ -106,7 +106,7 @@ Item {
         property var buffer: []
 
         command: ["bash", "-c",
-            `find "${root.cacheDir}" -type f \\( -iname "*.jpg" -o -iname "*.jpeg" -o -iname "*.png" -o -iname "*.webp" -o -iname "*.heic" \\) 2>/dev/null`
+            `find "${root.cacheDir}" -type f -not -path "${root.cacheDir}/display/*" \\( -iname "*.jpg" -o -iname "*.jpeg" -o -iname "*.png" -o -iname "*.webp" -o -iname "*.heic" \\) 2>/dev/null`
         ]
         running: false
         stdout: SplitParser {
@@ -238,7 +238,7 @@ Item {
         if (imageCount === 0) return
 
         currentIndex = index
-        const newSource = "file://" + imageFiles[index]
+        const newSource = displaySource(index)
 
         // Define o source na imagem OCULTA antes de fazer a transição
         if (showA) {
@@ -262,14 +262,21 @@ Item {
 
     function initializeFirstImage() {
         if (imageCount === 0) return
-        sourceA = "file://" + imageFiles[currentIndex]
+        sourceA = displaySource(currentIndex)
         sourceB = sourceA  // Inicialmente ambas com a mesma imagem
     }
 
     function getImageSource(offset: int): string {
         if (imageFiles.length === 0) return ""
         const idx = (currentIndex + offset) % imageFiles.length
-        return "file://" + imageFiles[idx]
+        return displaySource(idx)
+    }
+
+    // Cópia reduzida gerada pelo icloud_sync.py (campo "display" do metadata.json), ou o original
+    function displaySource(index: int): string {
+        const filepath = imageFiles[index]
+        const meta = photoMetadata[filepath.split('/').pop()] || {}
+        return "file://" + (meta.display ? `${cacheDir}/${meta.display}` : filepath)
     }
 
     function togglePinned() {
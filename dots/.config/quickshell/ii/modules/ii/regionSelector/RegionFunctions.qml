@@ -73,4 +73,30 @@ Singleton {
         // Remove overlapping image regions, keep only the smaller one
         return filterOverlappingImageRegions(filtered);
     }
+
+    function addImageRegion(regions, region, windowRegions, threshold = 0.1) {
+        // Same result as filterImageRegions([...regions, region], windowRegions)
+        // when regions is already filtered, without comparing every pair again
+        for (let i = 0; i < windowRegions.length; ++i) {
+            if (intersectionOverUnion(region, windowRegions[i]) > threshold)
+                return regions;
+        }
+        const area = region.size[0] * region.size[1];
+        let added = true;
+        let keep = [];
+        for (let i = 0; i < regions.length; ++i) {
+            const other = regions[i];
+            if (added && intersectionOverUnion(other, region) > 0) {
+                // Keep only the smaller one
+                if (other.size[0] * other.size[1] <= area)
+                    added = false;
+                else
+                    continue;
+            }
+            keep.push(other);
+        }
+        if (added)
+            keep.push(region);
+        return keep;
+    }
 }
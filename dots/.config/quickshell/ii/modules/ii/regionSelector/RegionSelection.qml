@@ -210,18 +210,24 @@ PanelWindow {
 
     Process {
         id: imageDetectionProcess
-        command: ["bash", "-c", `${Directories.scriptPath}/images/find-regions-venv.sh ` 
+        command: ["bash", "-c", `echo '${StringUtils.shellSingleQuoteEscape(JSON.stringify(root.windowRegions))}' | `
+            + `${Directories.scriptPath}/images/find-regions-venv.sh ` 
             + `--hyprctl ` 
+            + `--windows - --windows-mode exclude ` 
             + `--image '${StringUtils.shellSingleQuoteEscape(root.screenshotPath)}' ` 
             + `--max-width ${Math.round(root.screen.width * root.falsePositivePreventionRatio)} ` 
-            + `--max-height ${Math.round(root.screen.height * root.falsePositivePreventionRatio)} `]
-        stdout: StdioCollector {
-            id: imageDimensionCollector
-            onStreamFinished: {
-                imageRegions = RegionFunctions.filterImageRegions(
-                    JSON.parse(imageDimensionCollector.text),
-                    root.windowRegions
-                );
+            + `--max-height ${Math.round(root.screen.height * root.falsePositivePreventionRatio)} ` 
+            + `--stream `]
+        stdout: SplitParser {
+            // One region per line, largest first, so snapping works before the search finishes
+            onRead: data => {
+                const region = JSON.parse(data);
+                if (region.reset) {
+                    // Regions so far came from a quick pass, the final ones follow
+                    imageRegions = [];
+                    return;
+                }
+                imageRegions = RegionFunctions.addImageRegion(imageRegions, region, root.windowRegions);
             }
         }
     }
@@ -260,9 +260,13 @@ switch() {
                 sleep 0.1
             done
 
-            # Extract first frame for color generation
-            thumbnail="$THUMBNAIL_DIR/$(basename "$imgpath").jpg"
-            ffmpeg -y -i "$imgpath" -vframes 1 "$thumbnail" 2>/dev/null
+            # Frame for color generation: reuse the cached freedesktop thumbnail (made by thumbgen if missing),
+            # extracting the first frame ourselves only if that fails
+            thumbnail=$("$SCRIPT_DIR/../thumbnails/thumbgen-venv.sh" --size xx-large --file "$imgpath" 2>/dev/null | sed -n 's/^THUMBNAIL //p')
+            if [ ! -f "$thumbnail" ]; then
+                thumbnail="$THUMBNAIL_DIR/$(basename "$imgpath").jpg"
+                ffmpeg -y -i "$imgpath" -vframes 1 "$thumbnail" 2>/dev/null
+            fi
 
             # Set thumbnail path
             set_thumbnail_path "$thumbnail"
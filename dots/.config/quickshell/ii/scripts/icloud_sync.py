@@ -12,16 +12,36 @@ Uso:
     # Sincronizar álbum
     ./icloud_sync.py --album "Noiva" --max 200
 
+    # Sincronizar com mais downloads simultâneos
+    ./icloud_sync.py --album "Noiva" --jobs 8
+
+    # Percorrer os álbuns inteiros (por padrão para nas fotos já conhecidas)
+    ./icloud_sync.py --album "Noiva" --full
+
+    # Cópias para o widget em WebP de até 1280px (0 desativa)
+    ./icloud_sync.py --album "Noiva" --display-size 1280 --display-format webp
+
     # Gerar metadados para fotos existentes
     ./icloud_sync.py --metadata
+
+    # Gerar metadados sem rede, com uma base de cidades do GeoNames (cities15000.txt)
+    ./icloud_sync.py --metadata --geocoder offline --gazetteer ~/Downloads/cities15000.txt
 """
 
+import os
 import sys
 import argparse
 import re
 import hashlib
 import json
+import math
+import multiprocessing
+import queue
+import sqlite3
+import threading
 import time
+import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 from pathlib import Path
 from datetime import datetime
 
@@ -32,14 +52,21 @@ except ImportError:
     sys.exit(1)
 
 try:
-    from PIL import Image
-    from PIL.ExifTags import TAGS, GPSTAGS
+    from PIL import Image, ImageOps
     PILLOW_AVAILABLE = True
 except ImportError:
     PILLOW_AVAILABLE = False
 
+try:
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+    HEIF_AVAILABLE = True
+except ImportError:
+    HEIF_AVAILABLE = False
+
 try:
     import requests
+    from requests.adapters import HTTPAdapter
     REQUESTS_AVAILABLE = True
 except ImportError:
     REQUESTS_AVAILABLE = False
@@ -50,6 +77,38 @@ VIDEO_EXTENSIONS = {'.mov', '.mp4', '.avi', '.mkv', '.m4v', '.3gp'}
 # Extensões de imagem suportadas
 IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.heic', '.gif'}
 
+# Downloads: tentativas extras, espera base (dobra a cada tentativa) e tamanho dos blocos gravados
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 1.0
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 30
+
+# Cópias para exibição no widget: subpasta, maior lado padrão (px) e qualidade
+DISPLAY_DIR_NAME = "display"
+DISPLAY_SIZE = 1920
+DISPLAY_QUALITY = 85
+
+# Estado da sincronização, dentro do diretório de saída
+STATE_DB_NAME = ".sync_state.db"
+# PRAGMA user_version a partir do qual os JSON das versões anteriores já foram importados
+STATE_DB_LEGACY_IMPORTED = 1
+# Fração de páginas livres a partir da qual o banco é compactado (VACUUM)
+STATE_DB_COMPACT_THRESHOLD = 0.25
+
+# Sincronização incremental: fotos já conhecidas seguidas (da mais nova para a mais antiga) para parar
+KNOWN_RUN_STOP = 50
+
+# Tags EXIF usadas: ponteiros para os IFDs Exif e GPS e os campos lidos deles
+EXIF_IFD_POINTER = 0x8769
+GPS_IFD_POINTER = 0x8825
+TAG_DATETIME_ORIGINAL = 36867
+GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF, GPS_LONGITUDE = 1, 2, 3, 4
+
+# Geocoding: fotos a menos de ~1 km (2 casas decimais) dividem uma consulta; intervalo mínimo do Nominatim
+GEOCODE_CLUSTER_DIGITS = 2
+NOMINATIM_INTERVAL = 1.0
+DEFAULT_GAZETTEER = '~/.cache/quickshell/geonames/cities15000.txt'
+
 # Meses em português
 MONTHS_PT = ['janeiro', 'fevereiro', 'março', 'abril', 'maio', 'junho',
              'julho', 'agosto', 'setembro', 'outubro', 'novembro', 'dezembro']
@@ -100,56 +159,52 @@ def gps_to_decimal(coords, ref) -> float | None:
 
 
 def extract_exif_metadata(filepath: Path) -> dict | None:
-    """Extrai data e GPS do EXIF da foto."""
+    """Extrai data e GPS do EXIF da foto.
+
+    Image.open só lê o cabeçalho, os pixels nunca são decodificados; as tags
+    são buscadas direto nos IFDs em vez de percorrer todas.
+    """
     if not PILLOW_AVAILABLE:
         return None
 
     try:
-        img = Image.open(filepath)
-        exif = img._getexif()
-        if not exif:
-            return None
-
-        metadata = {}
-
-        # Extrai data
-        for tag_id, value in exif.items():
-            tag = TAGS.get(tag_id)
-            if tag == 'DateTimeOriginal':
-                metadata['date'] = value  # "2025:10:11 18:32:39"
-                metadata['date_formatted'] = format_date_pt(value)
-                break
-
-        # Extrai GPS (tag 34853 é GPSInfo)
-        gps_info = exif.get(34853)
-        if gps_info:
-            lat = gps_to_decimal(gps_info.get(2), gps_info.get(1))
-            lon = gps_to_decimal(gps_info.get(4), gps_info.get(3))
-            if lat is not None and lon is not None:
-                metadata['lat'] = lat
-                metadata['lon'] = lon
+        with Image.open(filepath) as img:
+            exif = img.getexif()
+            if not exif:
+                return None
+
+            metadata = {}
+
+            # Extrai data
+            date = exif.get_ifd(EXIF_IFD_POINTER).get(TAG_DATETIME_ORIGINAL)
+            if date:
+                metadata['date'] = date  # "2025:10:11 18:32:39"
+                metadata['date_formatted'] = format_date_pt(date)
+
+            # Extrai GPS
+            gps_info = exif.get_ifd(GPS_IFD_POINTER)
+            if gps_info:
+                lat = gps_to_decimal(gps_info.get(GPS_LATITUDE), gps_info.get(GPS_LATITUDE_REF))
+                lon = gps_to_decimal(gps_info.get(GPS_LONGITUDE), gps_info.get(GPS_LONGITUDE_REF))
+                if lat is not None and lon is not None:
+                    metadata['lat'] = lat
+                    metadata['lon'] = lon
 
         return metadata if metadata else None
     except Exception as e:
         return None
 
 
-def load_geocode_cache(cache_file: Path) -> dict:
+def load_geocode_cache(db: sqlite3.Connection) -> dict:
     """Carrega cache de geocoding."""
-    if cache_file.exists():
-        try:
-            return json.loads(cache_file.read_text())
-        except Exception:
-            pass
-    return {}
+    return {key: {"city": city, "state": state}
+            for key, city, state in db.execute("SELECT key, city, state FROM geocode")}
 
 
-def save_geocode_cache(cache_file: Path, cache: dict):
-    """Salva cache de geocoding."""
-    try:
-        cache_file.write_text(json.dumps(cache, indent=2, ensure_ascii=False))
-    except Exception:
-        pass
+def save_geocode_cache(db: sqlite3.Connection, entries: dict):
+    """Salva entradas novas no cache de geocoding."""
+    db.executemany("INSERT OR REPLACE INTO geocode (key, city, state) VALUES (?, ?, ?)",
+                   [(key, geo.get('city'), geo.get('state')) for key, geo in entries.items()])
 
 
 def reverse_geocode(lat: float, lon: float) -> tuple[str | None, str | None]:
@@ -175,45 +230,159 @@ def reverse_geocode(lat: float, lon: float) -> tuple[str | None, str | None]:
         return None, None
 
 
-def get_city_cached(lat: float, lon: float, cache: dict, cache_file: Path) -> dict:
-    """Obtém cidade do cache ou faz geocoding."""
-    # Arredonda para ~100m de precisão para cache
-    key = f"{round(lat, 3)},{round(lon, 3)}"
+def geocode_key(lat: float, lon: float, digits: int = 3) -> str:
+    """Chave do cache de geocoding (3 casas decimais: ~100m de precisão)."""
+    return f"{round(lat, digits)},{round(lon, digits)}"
 
-    if key in cache:
-        return cache[key]
 
-    city, state = reverse_geocode(lat, lon)
-    result = {"city": city, "state": state}
-    cache[key] = result
-    save_geocode_cache(cache_file, cache)
+def to_unit_vector(lat: float, lon: float) -> tuple[float, float, float]:
+    """Ponto na esfera unitária: distância euclidiana cresce com a distância real, sem problemas no antimeridiano."""
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
 
-    # Rate limiting para Nominatim (1 req/sec)
-    time.sleep(1)
 
-    return result
+class Gazetteer:
+    """Base offline de cidades (formato GeoNames), consultada pela cidade mais próxima numa KD-tree.
 
+    Usa um arquivo citiesXXXX.txt do GeoNames; se admin1CodesASCII.txt estiver na
+    mesma pasta, o estado vem por nome, senão fica vazio.
+    """
 
-def generate_metadata(output_dir: Path):
+    def __init__(self, path: Path):
+        admin1 = {}
+        admin1_file = path.parent / "admin1CodesASCII.txt"
+        if admin1_file.exists():
+            for line in admin1_file.read_text(encoding='utf-8').splitlines():
+                cols = line.split('\t')
+                if len(cols) >= 2:
+                    admin1[cols[0]] = cols[1]
+
+        self.places = []  # (cidade, estado)
+        points = []
+        for line in path.read_text(encoding='utf-8').splitlines():
+            cols = line.split('\t')
+            if len(cols) < 11:
+                continue
+            self.places.append((cols[1], admin1.get(f"{cols[8]}.{cols[10]}")))
+            points.append(to_unit_vector(float(cols[4]), float(cols[5])))
+        self.points = points
+        self.tree = self._build(list(range(len(points))), 0)
+
+    def _build(self, indices: list, depth: int):
+        # Nó: (índice do ponto, eixo, esquerda, direita)
+        if not indices:
+            return None
+        axis = depth % 3
+        indices.sort(key=lambda i: self.points[i][axis])
+        mid = len(indices) // 2
+        return (indices[mid], axis,
+                self._build(indices[:mid], depth + 1),
+                self._build(indices[mid + 1:], depth + 1))
+
+    def lookup(self, lat: float, lon: float) -> tuple[str | None, str | None]:
+        """Cidade e estado mais próximos das coordenadas."""
+        if self.tree is None:
+            return None, None
+        target = to_unit_vector(lat, lon)
+        best = [None, float('inf')]
+
+        def search(node):
+            if node is None:
+                return
+            index, axis, left, right = node
+            point = self.points[index]
+            dist = sum((a - b) ** 2 for a, b in zip(point, target))
+            if dist < best[1]:
+                best[0], best[1] = index, dist
+            diff = target[axis] - point[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            search(near)
+            if diff ** 2 < best[1]:
+                search(far)
+
+        search(self.tree)
+        return self.places[best[0]]
+
+
+class GeocodeQueue:
+    """Resolve coordenadas numa thread em segundo plano, enquanto o EXIF ainda está sendo lido.
+
+    Coordenadas próximas caem no mesmo cluster e geram uma única consulta. O
+    Nominatim é consultado no máximo uma vez por NOMINATIM_INTERVAL; sem rede
+    (ou sem resultado) a base offline responde, se houver.
+    """
+
+    def __init__(self, online: bool = True, gazetteer: Gazetteer | None = None):
+        self.online = online and REQUESTS_AVAILABLE
+        self.gazetteer = gazetteer
+        self.clusters = set()
+        self.results = {}  # chave do cluster -> {"city", "state"}
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def cluster_key(lat: float, lon: float) -> str:
+        return geocode_key(lat, lon, GEOCODE_CLUSTER_DIGITS)
+
+    def submit(self, lat: float, lon: float):
+        key = self.cluster_key(lat, lon)
+        if key not in self.clusters:
+            self.clusters.add(key)
+            self.queue.put((key, lat, lon))
+
+    def _run(self):
+        last_request = 0.0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            key, lat, lon = item
+            city, state = None, None
+            if self.online:
+                delay = last_request + NOMINATIM_INTERVAL - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                city, state = reverse_geocode(lat, lon)
+                last_request = time.monotonic()
+            if city is None and self.gazetteer is not None:
+                city, state = self.gazetteer.lookup(lat, lon)
+            self.results[key] = {"city": city, "state": state}
+
+    def finish(self) -> dict:
+        """Espera as consultas pendentes e retorna os resultados por cluster."""
+        self.queue.put(None)
+        self.thread.join()
+        return self.results
+
+
+def generate_metadata(output_dir: Path, geocoder: str = 'auto', gazetteer_path: Path | None = None):
     """Gera metadata.json para todas as fotos existentes."""
     if not PILLOW_AVAILABLE:
         print("ERRO: Pillow não instalado. Execute:")
         print("  pip install Pillow")
         sys.exit(1)
 
+    gazetteer = None
+    if geocoder != 'nominatim' and gazetteer_path and gazetteer_path.exists():
+        gazetteer = Gazetteer(gazetteer_path)
+        print(f"Base offline de cidades: {gazetteer_path} ({len(gazetteer.places)} cidades)")
+    elif geocoder == 'offline':
+        print(f"ERRO: base offline não encontrada: {gazetteer_path}")
+        print("  Baixe cities15000.zip em https://download.geonames.org/export/dump/")
+        sys.exit(1)
+
     metadata_file = output_dir / "metadata.json"
-    geocode_cache_file = output_dir / ".geocode_cache.json"
+    db = open_state_db(output_dir)
 
     # Carrega metadados existentes
-    existing_metadata = {}
-    if metadata_file.exists():
-        try:
-            existing_metadata = json.loads(metadata_file.read_text())
-        except Exception:
-            pass
+    existing_metadata = {filename: json.loads(data)
+                         for filename, data in db.execute("SELECT filename, data FROM photo_metadata")}
 
     # Carrega cache de geocoding
-    geocode_cache = load_geocode_cache(geocode_cache_file)
+    geocode_cache = load_geocode_cache(db)
+    new_geocodes = {}
+    new_metadata = {}
 
     # Lista arquivos de imagem
     image_files = []
@@ -229,20 +398,34 @@ def generate_metadata(output_dir: Path):
     errors = 0
     geocoded = 0
 
+    # Pula fotos que já têm metadados completos
+    pending_files = []
     for filepath in image_files:
+        meta = existing_metadata.get(filepath.name)
+        if meta and meta.get('date_formatted') and (meta.get('city') or not meta.get('lat')):
+            skipped += 1
+        else:
+            pending_files.append(filepath)
+
+    # EXIF lido em paralelo; coordenadas fora do cache já vão para o geocoding enquanto isso
+    geocode_queue = GeocodeQueue(online=geocoder != 'offline', gazetteer=gazetteer)
+    exif_results = []
+    with process_pool() as executor:
+        chunksize = max(1, len(pending_files) // ((os.cpu_count() or 1) * 4))
+        for exif_data in executor.map(extract_exif_metadata, pending_files, chunksize=chunksize):
+            exif_results.append(exif_data)
+            if exif_data and 'lat' in exif_data and geocode_key(exif_data['lat'], exif_data['lon']) not in geocode_cache:
+                geocode_queue.submit(exif_data['lat'], exif_data['lon'])
+
+    if geocode_queue.clusters:
+        print(f"Geocoding de {len(geocode_queue.clusters)} locais...")
+    clusters = geocode_queue.finish()
+
+    for filepath, exif_data in zip(pending_files, exif_results):
         filename = filepath.name
 
-        # Pula se já tem metadados completos
-        if filename in existing_metadata:
-            meta = existing_metadata[filename]
-            if meta.get('date_formatted') and (meta.get('city') or not meta.get('lat')):
-                skipped += 1
-                continue
-
         print(f"Processando: {filename}...", end=" ", flush=True)
 
-        exif_data = extract_exif_metadata(filepath)
-
         if not exif_data:
             print("sem EXIF")
             errors += 1
@@ -250,15 +433,17 @@ def generate_metadata(output_dir: Path):
 
         # Geocoding se tiver GPS
         if 'lat' in exif_data and 'lon' in exif_data:
-            geo = get_city_cached(exif_data['lat'], exif_data['lon'],
-                                  geocode_cache, geocode_cache_file)
+            key = geocode_key(exif_data['lat'], exif_data['lon'])
+            if key not in geocode_cache:
+                geocode_cache[key] = new_geocodes[key] = clusters[GeocodeQueue.cluster_key(exif_data['lat'], exif_data['lon'])]
+            geo = geocode_cache[key]
             if geo.get('city'):
                 exif_data['city'] = geo['city']
                 geocoded += 1
             if geo.get('state'):
                 exif_data['state'] = geo['state']
 
-        existing_metadata[filename] = exif_data
+        new_metadata[filename] = exif_data
         processed += 1
 
         info_parts = []
@@ -269,15 +454,20 @@ def generate_metadata(output_dir: Path):
 
         print(" | ".join(info_parts) if info_parts else "processado")
 
-    # Salva metadados
-    metadata_file.write_text(json.dumps(existing_metadata, indent=2, ensure_ascii=False))
+    # Só as entradas novas vão para o banco, numa transação; o metadata.json é exportado dele
+    save_geocode_cache(db, new_geocodes)
+    save_photo_metadata(db, new_metadata)
+    db.commit()
+    total = export_metadata(db, metadata_file)
+    compact_state_db(db)
+    db.close()
 
     print("-" * 50)
     print(f"Processados: {processed}")
     print(f"Já existiam: {skipped}")
     print(f"Sem EXIF: {errors}")
     print(f"Geolocalizados: {geocoded}")
-    print(f"Total no metadata.json: {len(existing_metadata)}")
+    print(f"Total no metadata.json: {total}")
 
 
 def get_2fa_code_gui() -> str | None:
@@ -348,9 +538,351 @@ def list_albums(api):
     print("-" * 40)
 
 
-def sync_albums(api, album_names: list, output_dir: Path, max_photos: int = 100):
+def configure_session(api, jobs: int):
+    """Dimensiona o pool de conexões da sessão para os downloads simultâneos.
+
+    O padrão do requests guarda só 10 conexões por host; com mais downloads
+    que isso as excedentes seriam fechadas e reabertas a cada foto.
+    """
+    if not REQUESTS_AVAILABLE:
+        return
+    try:
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(jobs, 10))
+        api.session.mount('https://', adapter)
+    except AttributeError:
+        pass
+
+
+def iter_download(download):
+    """Itera os blocos do retorno de photo.download()."""
+    if hasattr(download, 'iter_content'):
+        for chunk in download.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if chunk:
+                yield chunk
+    elif hasattr(download, 'content'):
+        yield download.content
+    elif hasattr(download, 'raw'):
+        yield download.raw.read()
+    elif isinstance(download, bytes):
+        yield download
+    else:
+        yield bytes(download)
+
+
+def photo_version(photo) -> tuple[str, dict] | None:
+    """Resolução a baixar (medium, ou original se não houver) com URL e tamanho, quando o pyicloud expõe."""
+    versions = getattr(photo, 'versions', None) or {}
+    for name in ('medium', 'original'):
+        if versions.get(name, {}).get('url'):
+            return name, versions[name]
+    return None
+
+
+def download_whole(photo, tmp_path: Path) -> str:
+    """Baixa a foto inteira com photo.download(). Retorna o SHA-256."""
+    download = photo.download('medium')
+
+    if download is None:
+        # Tenta versão original se medium não disponível
+        download = photo.download('original')
+
+    if download is None:
+        raise RuntimeError("download retornou None")
+
+    checksum = hashlib.sha256()
+    with open(tmp_path, 'wb') as f:
+        for chunk in iter_download(download):
+            checksum.update(chunk)
+            f.write(chunk)
+    return checksum.hexdigest()
+
+
+def download_resumable(session, version: tuple[str, dict], tmp_path: Path, version_tag: str | None) -> str:
+    """Baixa para tmp_path continuando de onde um download anterior parou. Retorna o SHA-256.
+
+    Um arquivo .json ao lado do .part guarda qual versão e resolução ele
+    contém; só então o restante é pedido com um Range. As URLs do iCloud
+    expiram, por isso não entram nessa identificação. No fim o tamanho é
+    conferido com o informado pelo iCloud.
+    """
+    resolution, info = version
+    expected_size = info.get('size')
+    sidecar = tmp_path.with_name(f"{tmp_path.name}.json")
+    state = {"version": version_tag, "resolution": resolution, "size": expected_size}
+
+    offset = 0
+    if tmp_path.exists() and sidecar.exists():
+        try:
+            if json.loads(sidecar.read_text()) == state:
+                offset = tmp_path.stat().st_size
+        except ValueError:
+            pass
+    if not offset:
+        tmp_path.unlink(missing_ok=True)
+    sidecar.write_text(json.dumps(state))
+
+    checksum = hashlib.sha256()
+    if offset:
+        with open(tmp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                checksum.update(chunk)
+
+    headers = {'Range': f"bytes={offset}-"} if offset else {}
+    with session.get(info['url'], headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if offset and response.status_code == 416 and offset != expected_size:
+            # O .part não corresponde ao arquivo remoto: a próxima tentativa recomeça do zero
+            tmp_path.unlink()
+            sidecar.unlink(missing_ok=True)
+            raise IOError("download parcial inválido, recomeçando")
+        if response.status_code != 416:
+            response.raise_for_status()
+            content_range = response.headers.get('Content-Range', '')
+            if offset and (response.status_code != 206 or not content_range.startswith(f"bytes {offset}-")):
+                # Servidor ignorou o Range: recomeça do zero
+                offset = 0
+                checksum = hashlib.sha256()
+            with open(tmp_path, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    checksum.update(chunk)
+                    f.write(chunk)
+
+    size = tmp_path.stat().st_size
+    if expected_size and size != expected_size:
+        if size > expected_size:
+            # Não é continuação do que temos: descarta
+            tmp_path.unlink()
+            sidecar.unlink(missing_ok=True)
+        raise IOError(f"tamanho {size} diferente do esperado ({expected_size})")
+    sidecar.unlink(missing_ok=True)
+    return checksum.hexdigest()
+
+
+def download_photo(photo, filepath: Path, session=None, version_tag: str | None = None,
+                   retries: int = DOWNLOAD_RETRIES) -> str:
+    """Baixa uma foto, tentando de novo com espera exponencial em caso de erro.
+
+    Grava em um arquivo oculto .part e renomeia ao terminar, então o
+    slideshow nunca vê uma foto pela metade. Com a sessão e a URL da versão
+    disponíveis, o .part sobrevive a falhas (e a execuções) e o download
+    continua dele. Retorna o SHA-256 do arquivo.
+    """
+    tmp_path = filepath.with_name(f".{filepath.name}.part")
+    version = photo_version(photo) if session is not None else None
+    for attempt in range(retries + 1):
+        try:
+            if version is None:
+                checksum = download_whole(photo, tmp_path)
+            else:
+                checksum = download_resumable(session, version, tmp_path, version_tag)
+            tmp_path.replace(filepath)
+            return checksum
+        except Exception:
+            if version is None:
+                tmp_path.unlink(missing_ok=True)
+            if attempt == retries:
+                raise
+            time.sleep(DOWNLOAD_BACKOFF * 2 ** attempt + random.uniform(0, DOWNLOAD_BACKOFF))
+
+
+def open_state_db(output_dir: Path) -> sqlite3.Connection:
+    """Abre (criando se preciso) o banco com o estado da sincronização.
+
+    Guarda, por asset do iCloud, a versão baixada, o fingerprint do original,
+    o SHA-256 e o arquivo local, além de em quais álbuns ele aparece e se
+    cada álbum já foi percorrido até o fim sem faltar nenhuma foto.
+    """
+    db = sqlite3.connect(output_dir / STATE_DB_NAME)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS assets (
+            asset_id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            version TEXT,
+            fingerprint TEXT,
+            checksum TEXT,
+            local_path TEXT NOT NULL,
+            synced_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS album_assets (
+            album TEXT NOT NULL,
+            asset_id TEXT NOT NULL,
+            PRIMARY KEY (album, asset_id)
+        );
+        CREATE TABLE IF NOT EXISTS album_walks (
+            album TEXT PRIMARY KEY,
+            complete INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS geocode (
+            key TEXT PRIMARY KEY,
+            city TEXT,
+            state TEXT
+        );
+        CREATE TABLE IF NOT EXISTS photo_metadata (
+            filename TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS derivatives (
+            local_path TEXT PRIMARY KEY,
+            display_path TEXT NOT NULL
+        );
+    """)
+    import_legacy_json(db, output_dir)
+    return db
+
+
+def import_legacy_json(db: sqlite3.Connection, output_dir: Path):
+    """Importa, uma única vez, o cache de geocoding e o metadata.json das versões em JSON.
+
+    O metadata.json passa a ser gerado a partir do banco a cada sincronização,
+    então a importação fica registrada no user_version do banco para não
+    reimportar o próprio arquivo exportado. O campo "display" nunca é
+    importado: ele vem só da tabela derivatives.
+    """
+    if db.execute("PRAGMA user_version").fetchone()[0] >= STATE_DB_LEGACY_IMPORTED:
+        return
+
+    geocode_file = output_dir / ".geocode_cache.json"
+    if geocode_file.exists():
+        try:
+            save_geocode_cache(db, json.loads(geocode_file.read_text()))
+            db.commit()
+            geocode_file.unlink()
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    metadata_file = output_dir / "metadata.json"
+    if metadata_file.exists() and not db.execute("SELECT 1 FROM photo_metadata LIMIT 1").fetchone():
+        try:
+            save_photo_metadata(db, json.loads(metadata_file.read_text()))
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    # Bancos anteriores a este controle podem já ter reimportado entradas com "display"
+    for filename, data in db.execute("SELECT filename, data FROM photo_metadata").fetchall():
+        meta = json.loads(data)
+        if 'display' not in meta:
+            continue
+        del meta['display']
+        if meta:
+            save_photo_metadata(db, {filename: meta})
+        else:
+            # Sem data nem cidade: o --metadata volta a extrair esta foto
+            db.execute("DELETE FROM photo_metadata WHERE filename = ?", (filename,))
+    db.execute(f"PRAGMA user_version = {STATE_DB_LEGACY_IMPORTED}")
+    db.commit()
+
+
+def save_photo_metadata(db: sqlite3.Connection, entries: dict):
+    """Salva (ou atualiza) os metadados de cada foto."""
+    entries = {filename: {key: value for key, value in meta.items() if key != 'display'}
+               for filename, meta in entries.items() if isinstance(meta, dict)}
+    db.executemany("INSERT OR REPLACE INTO photo_metadata (filename, data) VALUES (?, ?)",
+                   [(filename, json.dumps(meta, ensure_ascii=False)) for filename, meta in entries.items() if meta])
+
+
+def export_metadata(db: sqlite3.Connection, metadata_file: Path) -> int:
+    """Escreve o metadata.json lido pelo widget, atomicamente. Retorna o número de fotos.
+
+    Além de data e cidade, cada foto com cópia de exibição ganha o campo
+    "display", o caminho (relativo) que o widget carrega no lugar do original,
+    desde que a cópia ainda exista.
+    """
+    metadata = {filename: json.loads(data)
+                for filename, data in db.execute("SELECT filename, data FROM photo_metadata ORDER BY filename")}
+    for local_path, display_path in db.execute("SELECT local_path, display_path FROM derivatives"):
+        if (metadata_file.parent / display_path).exists():
+            metadata.setdefault(local_path, {})['display'] = display_path
+    tmp_file = metadata_file.with_name(f".{metadata_file.name}.tmp")
+    tmp_file.write_text(json.dumps(metadata, ensure_ascii=False))
+    tmp_file.replace(metadata_file)
+    return len(metadata)
+
+
+def compact_state_db(db: sqlite3.Connection):
+    """Compacta o banco quando muitas páginas ficaram livres (entradas apagadas ou reescritas)."""
+    page_count = db.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = db.execute("PRAGMA freelist_count").fetchone()[0]
+    if page_count and freelist_count / page_count > STATE_DB_COMPACT_THRESHOLD:
+        db.execute("VACUUM")
+
+
+def load_synced_assets(db: sqlite3.Connection) -> dict:
+    """Retorna {asset_id: (versão, arquivo local)} para decidir o que pular."""
+    return {asset_id: (version, local_path)
+            for asset_id, version, local_path in db.execute("SELECT asset_id, version, local_path FROM assets")}
+
+
+def record_asset(db: sqlite3.Connection, asset_id: str, filename: str, version: str | None,
+                 fingerprint: str | None, checksum: str | None, local_path: str):
+    """Registra (ou atualiza) um asset sincronizado."""
+    db.execute(
+        "INSERT OR REPLACE INTO assets (asset_id, filename, version, fingerprint, checksum, local_path, synced_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (asset_id, filename, version, fingerprint, checksum, local_path, time.time()))
+
+
+def asset_version(photo) -> str | None:
+    """recordChangeTag do registro mestre: muda quando a foto é editada ou substituída."""
+    try:
+        return photo._master_record.get('recordChangeTag')
+    except AttributeError:
+        return None
+
+
+def asset_fingerprint(photo) -> str | None:
+    """Fingerprint do original calculado pela Apple."""
+    try:
+        return photo._master_record['fields']['resOriginalFingerprint']['value']
+    except (AttributeError, KeyError, TypeError):
+        return None
+
+
+def process_pool() -> ProcessPoolExecutor:
+    """Pool de processos iniciados por um forkserver.
+
+    Os pools são criados com threads já rodando (downloads, geocoding); um
+    fork direto copiaria locks presos por elas para os processos filhos.
+    """
+    return ProcessPoolExecutor(mp_context=multiprocessing.get_context('forkserver'))
+
+
+def make_display_copy(src: Path, dst: Path, max_size: int, fmt: str):
+    """Gera a cópia reduzida que o widget exibe (roda no pool de processos).
+
+    Aplica a orientação do EXIF, reduz para caber em max_size x max_size e
+    grava sem metadados. Para JPEG o decodificador já reduz na leitura (draft),
+    sem carregar a foto inteira na memória.
+    """
+    with Image.open(src) as img:
+        img.draft('RGB', (max_size, max_size))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_size, max_size), Image.LANCZOS)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        tmp_path = dst.with_name(f".{dst.name}.tmp")
+        if fmt == 'webp':
+            img.save(tmp_path, 'WEBP', quality=DISPLAY_QUALITY, method=4)
+        else:
+            img.save(tmp_path, 'JPEG', quality=DISPLAY_QUALITY, optimize=True, progressive=True)
+        tmp_path.replace(dst)
+
+
+def newest_first(album) -> bool:
+    """Faz o álbum ser listado da foto mais nova para a mais antiga.
+
+    Retorna False se esta versão do pyicloud não permite escolher a ordem.
+    """
+    if not hasattr(album, 'direction'):
+        return False
+    album.direction = 'DESCENDING'
+    return True
+
+
+def sync_albums(api, album_names: list, output_dir: Path, max_photos: int = 100, jobs: int = 4,
+                incremental: bool = True, display_size: int = DISPLAY_SIZE, display_format: str = 'jpeg'):
     """Sincroniza fotos de múltiplos álbuns."""
     output_dir.mkdir(parents=True, exist_ok=True)
+    configure_session(api, jobs)
+    session = getattr(api, 'session', None)
 
     # Encontra todos os álbuns
     albums = []
@@ -370,13 +902,11 @@ def sync_albums(api, album_names: list, output_dir: Path, max_photos: int = 100)
 
     print(f"\nDestino: {output_dir}")
 
-    # Lista arquivos existentes
-    existing = set()
-    for f in output_dir.iterdir():
-        if f.is_file() and not f.name.startswith('.'):
-            existing.add(f.stem.split('_', 1)[0])
+    db = open_state_db(output_dir)
+    synced = load_synced_assets(db)
+    claimed_paths = {local_path for _, local_path in synced.values()}
 
-    print(f"Já existem {len(existing)} fotos no cache")
+    print(f"Já existem {len(synced)} fotos no cache")
     print("-" * 50)
 
     downloaded = 0
@@ -385,22 +915,113 @@ def sync_albums(api, album_names: list, output_dir: Path, max_photos: int = 100)
     skipped_format = 0
     skipped_duplicate = 0
     errors = 0
-    seen_hashes = set()  # Evita duplicatas entre álbuns
-
+    display_errors = 0
+    seen_ids = set()  # Evita duplicatas entre álbuns
+
+    # Cópias para exibição geradas num pool de processos conforme as fotos chegam
+    derived = {local_path: display_path
+               for local_path, display_path in db.execute("SELECT local_path, display_path FROM derivatives")}
+    display_pool = None
+    if display_size > 0 and PILLOW_AVAILABLE:
+        display_pool = process_pool()
+        (output_dir / DISPLAY_DIR_NAME).mkdir(exist_ok=True)
+    display_pending = {}  # future -> (local_path, display_path)
+
+    def queue_display_copy(local_path: str):
+        if display_pool is None:
+            return
+        if local_path in derived and (output_dir / derived[local_path]).exists():
+            return
+        if Path(local_path).suffix.lower() == '.heic' and not HEIF_AVAILABLE:
+            return
+        ext = 'webp' if display_format == 'webp' else 'jpg'
+        display_path = f"{DISPLAY_DIR_NAME}/{local_path}.{ext}"
+        future = display_pool.submit(make_display_copy, output_dir / local_path, output_dir / display_path,
+                                     display_size, display_format)
+        display_pending[future] = (local_path, display_path)
+
+    def forget_display_copy(local_path: str):
+        display_path = derived.pop(local_path, None)
+        if display_path:
+            (output_dir / display_path).unlink(missing_ok=True)
+            db.execute("DELETE FROM derivatives WHERE local_path = ?", (local_path,))
+
+    # Os álbuns são percorridos aqui enquanto até `jobs` fotos baixam em paralelo
+    pending = {}  # future -> (asset_id, filename, version, fingerprint, local_path)
+    failed_ids = set()
+
+    def collect(return_when):
+        nonlocal downloaded, errors
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            asset_id, filename, version, fingerprint, local_path = pending.pop(future)
+            error = future.exception()
+            if error:
+                print(f"ERRO: {filename}: {error}")
+                errors += 1
+                failed_ids.add(asset_id)
+                continue
+            print(f"OK: {filename}")
+            downloaded += 1
+            # Uma versão nova pode ter mudado de nome; a cópia antiga sai
+            previous = synced.get(asset_id)
+            if previous and previous[1] != local_path:
+                (output_dir / previous[1]).unlink(missing_ok=True)
+            if previous:
+                forget_display_copy(previous[1])
+            record_asset(db, asset_id, filename, version, fingerprint, future.result(), local_path)
+            synced[asset_id] = (version, local_path)
+            queue_display_copy(local_path)
+        db.commit()
+
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    walked = []  # Álbuns percorridos até o fim (ou até as fotos já sincronizadas) nesta execução
     for album in albums:
         if downloaded >= max_photos:
             break
 
         print(f"\n📁 Processando: {album.title}")
 
+        # Fotos vistas neste álbum em execuções anteriores
+        album_known = {asset_id for (asset_id,) in db.execute(
+            "SELECT asset_id FROM album_assets WHERE album = ?", (album.title,))}
+        # Parar nas fotos conhecidas só é seguro depois que uma passada chegou ao fim do álbum:
+        # antes disso (primeira sincronização, ou uma cortada pelo --max) pode haver fotos
+        # antigas ainda não baixadas depois delas, e a passada seguinte continua até elas
+        walk = db.execute("SELECT complete FROM album_walks WHERE album = ?", (album.title,)).fetchone()
+        album_incremental = incremental and bool(album_known) and bool(walk and walk[0])
+        if not newest_first(album) and album_incremental:
+            print("Aviso: pyicloud não lista do mais novo ao mais antigo, percorrendo o álbum inteiro")
+            album_incremental = False
+        known_run = 0
+        finished = True
+
         for photo in album:
+            # Downloads em andamento contam para o limite; se algum falhar, a vaga volta
+            while pending and (len(pending) >= jobs or downloaded + len(pending) >= max_photos):
+                collect(FIRST_COMPLETED)
             if downloaded >= max_photos:
                 print(f"\nLimite de {max_photos} fotos atingido.")
+                finished = False
                 break
 
             filename = photo.filename
             ext = Path(filename).suffix.lower()
 
+            # Identidade do asset no iCloud: fotos diferentes com o mesmo nome não colidem
+            asset_id = photo.id
+
+            # Conhecida = vista antes neste álbum e já baixada (ou ignorada pelo formato)
+            if asset_id in album_known and (asset_id in synced or ext not in IMAGE_EXTENSIONS):
+                known_run += 1
+                if album_incremental and known_run >= KNOWN_RUN_STOP:
+                    print(f"{known_run} fotos seguidas já sincronizadas, o restante do álbum também já está.")
+                    break
+            else:
+                known_run = 0
+            db.execute("INSERT OR IGNORE INTO album_assets (album, asset_id) VALUES (?, ?)",
+                       (album.title, asset_id))
+
             # Ignora vídeos
             if ext in VIDEO_EXTENSIONS:
                 skipped_video += 1
@@ -411,60 +1032,75 @@ def sync_albums(api, album_names: list, output_dir: Path, max_photos: int = 100)
                 skipped_format += 1
                 continue
 
-            # ID único baseado no hash
-            photo_hash = hashlib.md5(filename.encode()).hexdigest()[:12]
-
             # Verifica duplicata entre álbuns (mesma foto em Noiva e Favorites)
-            if photo_hash in seen_hashes:
+            if asset_id in seen_ids:
                 skipped_duplicate += 1
                 continue
-            seen_hashes.add(photo_hash)
+            seen_ids.add(asset_id)
 
-            if photo_hash in existing:
+            version = asset_version(photo)
+            previous = synced.get(asset_id)
+            if previous and previous[0] == version and (output_dir / previous[1]).exists():
                 skipped_existing += 1
+                queue_display_copy(previous[1])
                 continue
 
             # Nome seguro
             safe_name = re.sub(r'[^a-zA-Z0-9._-]', '_', filename)
-            filepath = output_dir / f"{photo_hash}_{safe_name}"
 
-            try:
-                print(f"Baixando: {filename}...", end=" ", flush=True)
-                download = photo.download('medium')
-
-                if download is None:
-                    # Tenta versão original se medium não disponível
-                    download = photo.download('original')
-
-                if download is None:
-                    print("ERRO: download retornou None")
-                    errors += 1
-                    continue
-
-                # Escreve o arquivo
-                with open(filepath, 'wb') as f:
-                    if hasattr(download, 'iter_content'):
-                        for chunk in download.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-                    elif hasattr(download, 'content'):
-                        f.write(download.content)
-                    elif hasattr(download, 'raw'):
-                        f.write(download.raw.read())
-                    elif isinstance(download, bytes):
-                        f.write(download)
-                    else:
-                        f.write(bytes(download))
-
-                print("OK")
-                downloaded += 1
-                existing.add(photo_hash)
+            # Arquivo de versões anteriores do script (hash do nome): adota em vez de baixar de novo,
+            # mas só para o primeiro asset com esse nome
+            legacy_path = f"{hashlib.md5(filename.encode()).hexdigest()[:12]}_{safe_name}"
+            if not previous and legacy_path not in claimed_paths and (output_dir / legacy_path).exists():
+                record_asset(db, asset_id, filename, version, asset_fingerprint(photo), None, legacy_path)
+                synced[asset_id] = (version, legacy_path)
+                claimed_paths.add(legacy_path)
+                skipped_existing += 1
+                queue_display_copy(legacy_path)
+                continue
+
+            local_path = f"{hashlib.md5(asset_id.encode()).hexdigest()[:12]}_{safe_name}"
 
+            print(f"Baixando: {filename}...")
+            future = executor.submit(download_photo, photo, output_dir / local_path, session, version)
+            pending[future] = (asset_id, filename, version, asset_fingerprint(photo), local_path)
+
+        if finished:
+            walked.append(album.title)
+        else:
+            db.execute("INSERT OR REPLACE INTO album_walks (album, complete) VALUES (?, 0)", (album.title,))
+
+    if pending:
+        collect(ALL_COMPLETED)
+    executor.shutdown()
+
+    # Um download que falhou também deixa o álbum incompleto: a foto pode estar depois
+    # das que a próxima passada encontraria já sincronizadas
+    for title in walked:
+        album_ids = {asset_id for (asset_id,) in db.execute(
+            "SELECT asset_id FROM album_assets WHERE album = ?", (title,))}
+        db.execute("INSERT OR REPLACE INTO album_walks (album, complete) VALUES (?, ?)",
+                   (title, int(not album_ids & failed_ids)))
+
+    if display_pool is not None:
+        if display_pending:
+            print(f"\nGerando {len(display_pending)} cópias para exibição...")
+        for future, (local_path, display_path) in display_pending.items():
+            try:
+                future.result()
             except Exception as e:
-                print(f"ERRO: {e}")
-                errors += 1
-                if filepath.exists():
-                    filepath.unlink()
+                print(f"ERRO na cópia de exibição de {local_path}: {e}")
+                display_errors += 1
+                continue
+            derived[local_path] = display_path
+            db.execute("INSERT OR REPLACE INTO derivatives (local_path, display_path) VALUES (?, ?)",
+                       (local_path, display_path))
+        display_pool.shutdown()
+
+    db.commit()
+    export_metadata(db, output_dir / "metadata.json")
+    compact_state_db(db)
+    db.close()
 
     print("\n" + "=" * 50)
     print(f"📊 RESUMO:")
@@ -474,6 +1110,8 @@ def sync_albums(api, album_names: list, output_dir: Path, max_photos: int = 100)
     print(f"  Vídeos ignorados: {skipped_video}")
     print(f"  Formatos ignorados: {skipped_format}")
     print(f"  Erros: {errors}")
+    if display_pool is not None:
+        print(f"  Cópias para exibição: {len(derived)} ({display_errors} com erro)")
     print(f"  Total no cache: {len(list(output_dir.glob('*')))}")
 
     # Metadados
@@ -492,8 +1130,19 @@ def main():
                         default='~/.cache/quickshell/icloud-photos',
                         help='Diretório de saída')
     parser.add_argument('--max', type=int, default=200, help='Máximo de fotos')
+    parser.add_argument('--jobs', type=int, default=4, help='Downloads simultâneos')
+    parser.add_argument('--display-size', type=int, default=DISPLAY_SIZE,
+                        help='Maior lado das cópias reduzidas que o widget exibe (0 desativa)')
+    parser.add_argument('--display-format', choices=['jpeg', 'webp'], default='jpeg',
+                        help='Formato das cópias para exibição')
+    parser.add_argument('--full', action='store_true',
+                        help='Percorre os álbuns inteiros em vez de parar nas fotos já sincronizadas')
     parser.add_argument('--metadata', action='store_true',
                         help='Gera metadata.json com data/cidade das fotos')
+    parser.add_argument('--geocoder', choices=['auto', 'nominatim', 'offline'], default='auto',
+                        help='Geocoding das fotos: Nominatim, base offline de cidades, ou ambos (auto)')
+    parser.add_argument('--gazetteer', type=str, default=DEFAULT_GAZETTEER,
+                        help='Arquivo de cidades do GeoNames (citiesXXXX.txt) para o geocoding offline')
     parser.add_argument('--2fa', type=str, dest='code_2fa',
                         help='Código 2FA (para autenticação não-interativa)')
 
@@ -501,7 +1150,7 @@ def main():
     output_dir = Path(args.output).expanduser()
 
     if args.metadata:
-        generate_metadata(output_dir)
+        generate_metadata(output_dir, args.geocoder, Path(args.gazetteer).expanduser())
         return
 
     if args.auth:
@@ -522,7 +1171,8 @@ def main():
     if args.album:
         # Suporta múltiplos álbuns separados por vírgula
         album_names = [name.strip() for name in args.album.split(',')]
-        sync_albums(api, album_names, output_dir, args.max)
+        sync_albums(api, album_names, output_dir, args.max, max(1, args.jobs), incremental=not args.full,
+                    display_size=args.display_size, display_format=args.display_format)
         return
 
     parser.print_help()
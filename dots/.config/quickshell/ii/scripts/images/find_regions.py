@@ -1,100 +1,448 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import cv2
+import hashlib
 import json
 import numpy as np
+import os
 import sys
+import tempfile
 
 DEFAULT_IMAGE_PATH = '/tmp/quickshell/media/screenshot/image'
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'quickshell', 'find_regions')
+CACHE_MAX_ENTRIES = 16
 
-def iou(boxA, boxB):
-    # Compute intersection over union for two boxes
-    xA = max(boxA['x'], boxB['x'])
-    yA = max(boxA['y'], boxB['y'])
-    xB = min(boxA['x'] + boxA['width'], boxB['x'] + boxB['width'])
-    yB = min(boxA['y'] + boxA['height'], boxB['y'] + boxB['height'])
-    interW = max(0, xB - xA)
-    interH = max(0, yB - yA)
-    interArea = interW * interH
-    boxAArea = boxA['width'] * boxA['height']
-    boxBArea = boxB['width'] * boxB['height']
-    iou = interArea / float(boxAArea + boxBArea - interArea) if (boxAArea + boxBArea - interArea) > 0 else 0
-    return iou
-
-def non_max_suppression(regions, iou_threshold=0.7):
+def areas(rects):
+    # Area of each (x, y, w, h) row
+    return rects[:, 2] * rects[:, 3]
+
+def iou(box, boxes):
+    # Compute intersection over union of one box against an array of boxes
+    xA = np.maximum(box[0], boxes[:, 0])
+    yA = np.maximum(box[1], boxes[:, 1])
+    xB = np.minimum(box[0] + box[2], boxes[:, 0] + boxes[:, 2])
+    yB = np.minimum(box[1] + box[3], boxes[:, 1] + boxes[:, 3])
+    interArea = np.maximum(0, xB - xA) * np.maximum(0, yB - yA)
+    unionArea = box[2] * box[3] + areas(boxes) - interArea
+    return np.divide(interArea, unionArea, out=np.zeros(len(boxes), dtype=np.float64), where=unionArea > 0)
+
+def non_max_suppression(rects, iou_threshold=0.7, kept=None):
+    # Boxes already kept from earlier batches suppress without being returned again
+    for box in kept if kept is not None else ():
+        rects = rects[iou(box, rects) < iou_threshold]
     # Sort by area (largest first)
-    regions = sorted(regions, key=lambda r: r['width'] * r['height'], reverse=True)
+    rects = rects[np.argsort(-areas(rects), kind='stable')]
     keep = []
-    while regions:
-        current = regions.pop(0)
+    while len(rects):
+        current = rects[0]
         keep.append(current)
-        regions = [r for r in regions if iou(current, r) < iou_threshold]
-    return keep
+        rects = rects[1:]
+        rects = rects[iou(current, rects) < iou_threshold]
+    return np.array(keep, dtype=np.int64).reshape(-1, 4)
 
-def find_regions(image_path, min_width, min_height, max_width=None, max_height=None, quality=False, k=150, min_size=20, sigma=0.8, resize_factor=1.0):
-    image = cv2.imread(image_path)
-    if image is None:
-        print(f'Error: Could not load image {image_path}', file=sys.stderr)
+def scale_rects(rects, resize_factor=1.0):
+    rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+    # Scale regions back to original image size if resized
+    if resize_factor != 1.0:
+        rects = (rects / resize_factor).astype(np.int64)
+    return rects
+
+def filter_rects(rects, orig_w, orig_h, min_width, min_height, max_width=None, max_height=None):
+    x, y, w, h = rects.T
+    # Filter out region that is exactly the same size as the original image
+    mask = ~((w == orig_w) & (h == orig_h) & (x == 0) & (y == 0))
+    mask &= (w > min_width) & (h > min_height)
+    if max_width is not None:
+        mask &= w < max_width
+    if max_height is not None:
+        mask &= h < max_height
+    return rects[mask]
+
+def cache_key(data, quality, k, min_size, sigma, resize_factor, windows=None, tiles=None, tile_overlap=0.0, engine='selective-search', flat_regions=False):
+    # Content hash of the encoded (or raw) image plus everything that affects the proposals
+    h = hashlib.blake2b(data, digest_size=16)
+    h.update(f'{engine}:{"quality" if quality else "fast"}:{k}:{min_size}:{sigma}:{flat_regions}:{resize_factor}:{tiles}:{tile_overlap}'.encode())
+    if windows is not None:
+        h.update(windows.tobytes())
+    return h.hexdigest()
+
+def load_cached_proposals(cache_dir, key):
+    try:
+        with np.load(os.path.join(cache_dir, f'{key}.npz')) as cached:
+            return cached['rects'], tuple(cached['shape'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_cached_proposals(cache_dir, key, rects, shape):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, rects=rects, shape=np.array(shape))
+        os.replace(tmp_path, os.path.join(cache_dir, f'{key}.npz'))
+        # Keep only the most recent entries, screenshots rarely repeat beyond that
+        entries = sorted((e for e in os.scandir(cache_dir) if e.name.endswith('.npz')), key=lambda e: e.stat().st_mtime, reverse=True)
+        for entry in entries[CACHE_MAX_ENTRIES:]:
+            os.unlink(entry.path)
+    except OSError as e:
+        print(f'Warning: Could not write region cache: {e}', file=sys.stderr)
+
+def load_windows(path, offset_x=0, offset_y=0, workspace=None, monitor=None):
+    # Accepts `hyprctl clients -j`, `hyprctl layers -j` or a plain list of {"at": [x, y], "size": [w, h]}
+    # hyprctl lists every workspace and monitor; workspace (an id) and monitor (a name) keep only the visible ones
+    try:
+        if path == '-':
+            data = json.load(sys.stdin)
+        else:
+            with open(path) as f:
+                data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f'Error: Could not load window geometry from {path}: {e}', file=sys.stderr)
         sys.exit(1)
+    rects = []
+    if isinstance(data, dict):
+        # Layers, per monitor. Background and bottom levels would cover the whole screen
+        for name, layer_monitor in data.items():
+            if monitor is not None and name != monitor:
+                continue
+            for level, layers in layer_monitor.get('levels', {}).items():
+                if level in ('0', '1'):
+                    continue
+                rects.extend([l['x'], l['y'], l['w'], l['h']] for l in layers)
+    else:
+        for window in data:
+            if not window.get('mapped', True) or window.get('hidden', False):
+                continue
+            if workspace is not None and window.get('workspace', {}).get('id', workspace) != workspace:
+                continue
+            rects.append([*window['at'], *window['size']])
+    rects = np.array(rects, dtype=np.int64).reshape(-1, 4)
+    rects[:, 0] -= offset_x
+    rects[:, 1] -= offset_y
+    return rects[(rects[:, 2] > 0) & (rects[:, 3] > 0)]
+
+def coverage_mask(windows, shape, scale=1.0):
+    # Boolean mask of the pixels covered by any window, at the given scale
+    mask = np.zeros(shape, dtype=bool)
+    for x, y, w, h in np.round(windows * scale).astype(np.int64).tolist():
+        mask[max(0, y):max(0, y + h), max(0, x):max(0, x + w)] = True
+    return mask
+
+def covered_fraction(rects, windows, orig_w, orig_h, scale=1.0):
+    # Fraction of each rect's area that lies under a known window
+    mask = coverage_mask(windows, (int(np.ceil(orig_h * scale)), int(np.ceil(orig_w * scale))), scale)
+    integral = cv2.integral(mask.astype(np.uint8))
+    mask_h, mask_w = mask.shape
+    x0 = np.clip(np.round(rects[:, 0] * scale).astype(np.int64), 0, mask_w)
+    y0 = np.clip(np.round(rects[:, 1] * scale).astype(np.int64), 0, mask_h)
+    x1 = np.clip(np.round((rects[:, 0] + rects[:, 2]) * scale).astype(np.int64), 0, mask_w)
+    y1 = np.clip(np.round((rects[:, 1] + rects[:, 3]) * scale).astype(np.int64), 0, mask_h)
+    covered = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    area = (x1 - x0) * (y1 - y0)
+    return np.divide(covered, area, out=np.ones(len(rects), dtype=np.float64), where=area > 0)
+
+def prepare_search_image(image, resize_factor=1.0, windows=None):
+    # Downscaled image to search and the offset of its origin, or (None, None) if nothing is left to search
     orig_h, orig_w = image.shape[:2]
     if resize_factor != 1.0:
         image = cv2.resize(image, (int(orig_w * resize_factor), int(orig_h * resize_factor)), interpolation=cv2.INTER_AREA)
+    offset = np.zeros(4, dtype=np.int64)
+    if windows is not None and len(windows):
+        # Only search the part of the screen not already covered by known windows
+        mask = coverage_mask(windows, image.shape[:2], resize_factor)
+        ys, xs = np.nonzero(~mask)
+        if not len(xs):
+            return None, None
+        x0, y0, x1, y1 = xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+        image = image[y0:y1, x0:x1].copy()
+        # Flatten covered pixels so they collapse into a single segment
+        image[mask[y0:y1, x0:x1]] = 0
+        offset[:2] = x0, y0
+    return image, offset
+
+def selective_search(image, quality=False, k=150, min_size=20, sigma=0.8):
     ss = cv2.ximgproc.segmentation.createSelectiveSearchSegmentation()
     ss.setBaseImage(image)
     if quality:
         ss.switchToSelectiveSearchQuality(k, min_size, sigma)
     else:
         ss.switchToSelectiveSearchFast(k, min_size, sigma)
-    rects = ss.process()
-    regions = []
-    for (x, y, w, h) in rects:
-        # Scale regions back to original image size if resized
-        if resize_factor != 1.0:
-            x = int(x / resize_factor)
-            y = int(y / resize_factor)
-            w = int(w / resize_factor)
-            h = int(h / resize_factor)
-        # Filter out region that is exactly the same size as the original image
-        if w == orig_w and h == orig_h and x == 0 and y == 0:
-            continue
-        if w > min_width and h > min_height:
-            if (max_width is None or w < max_width) and (max_height is None or h < max_height):
-                regions.append({'x': int(x), 'y': int(y), 'width': int(w), 'height': int(h)})
-    # Remove duplicates/overlaps
-    regions = non_max_suppression(regions, iou_threshold=0.7)
-    return regions, cv2.imread(image_path)  # Return original image for drawing
-
-def draw_regions(image, regions, output_path):
-    for region in regions:
-        if 'x' in region:
-            x, y, w, h = region['x'], region['y'], region['width'], region['height']
-        elif 'at' in region and 'size' in region:
-            x, y = region['at']
-            w, h = region['size']
+    return np.asarray(ss.process(), dtype=np.int64).reshape(-1, 4)
+
+def contour_search(image, flat_regions=False):
+    # Edges closed into blobs, then the bounding box of every contour. Needs no opencv-contrib
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    kernel_size = max(3, round(min(gray.shape) * 0.01) | 1)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+    edges = cv2.morphologyEx(cv2.Canny(gray, 50, 150), cv2.MORPH_CLOSE, kernel)
+    contours, _ = cv2.findContours(edges, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    rects = [cv2.boundingRect(contour) for contour in contours]
+    if flat_regions:
+        # Areas of (nearly) uniform color, like panels and backgrounds
+        flat = (cv2.morphologyEx(gray, cv2.MORPH_GRADIENT, kernel) < 8).astype(np.uint8)
+        _, _, stats, _ = cv2.connectedComponentsWithStats(flat, connectivity=4)
+        rects.extend(stats[1:, :4].tolist())  # Label 0 is the non-flat background
+    return np.array(rects, dtype=np.int64).reshape(-1, 4)
+
+ENGINES = {
+    'selective-search': selective_search,
+    'contours': contour_search,
+}
+
+def search_regions(image, engine='selective-search', resize_factor=1.0, windows=None, **params):
+    # Proposals in the coordinates of the original image
+    image, offset = prepare_search_image(image, resize_factor, windows)
+    if image is None:
+        return np.empty((0, 4), dtype=np.int64)
+    return scale_rects(ENGINES[engine](image, **params) + offset, resize_factor)
+
+def parse_tiles(value):
+    try:
+        cols, rows = (int(n) for n in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid tile grid "{value}", expected COLSxROWS like 2x2')
+    if cols < 1 or rows < 1:
+        raise argparse.ArgumentTypeError(f'Invalid tile grid "{value}", both dimensions must be positive')
+    return cols, rows
+
+def tile_bounds(width, height, cols, rows, overlap):
+    # (core, padded) bounds of each tile as (x0, y0, x1, y1); tiles extend into their neighbours by `overlap` of their size
+    xs = np.linspace(0, width, cols + 1).astype(np.int64)
+    ys = np.linspace(0, height, rows + 1).astype(np.int64)
+    for y0, y1 in zip(ys[:-1], ys[1:]):
+        for x0, x1 in zip(xs[:-1], xs[1:]):
+            pad_x = int((x1 - x0) * overlap)
+            pad_y = int((y1 - y0) * overlap)
+            padded = (max(0, x0 - pad_x), max(0, y0 - pad_y), min(width, x1 + pad_x), min(height, y1 + pad_y))
+            yield (x0, y0, x1, y1), padded
+
+def drop_seam_rects(rects, padded, width, height, tolerance=1):
+    # Proposals reaching an edge the tile shares with a neighbour are the tile itself or objects cut
+    # by the seam; both are left to the coarse pass, which sees those objects whole
+    x0, y0, x1, y1 = padded
+    touches = np.zeros(len(rects), dtype=bool)
+    if x0 > 0:
+        touches |= rects[:, 0] <= x0 + tolerance
+    if y0 > 0:
+        touches |= rects[:, 1] <= y0 + tolerance
+    if x1 < width:
+        touches |= rects[:, 0] + rects[:, 2] >= x1 - tolerance
+    if y1 < height:
+        touches |= rects[:, 1] + rects[:, 3] >= y1 - tolerance
+    # A 1x1 grid has no seams, but its only tile is still the whole image
+    touches |= (rects[:, 0] <= x0) & (rects[:, 1] <= y0) & (rects[:, 0] + rects[:, 2] >= x1) & (rects[:, 1] + rects[:, 3] >= y1)
+    return rects[~touches]
+
+def _search_tile(image, origin, engine, resize_factor, windows, params):
+    # Runs in a worker process, returns rects in the coordinates of the image the tile was cut from
+    rects = search_regions(image, engine, resize_factor, windows, **params)
+    return rects + np.array([*origin, 0, 0], dtype=np.int64)
+
+def iter_tiled_search(image, tiles, tile_overlap=0.15, workers=None, engine='selective-search', resize_factor=1.0, windows=None, **params):
+    # Yields (index, rects) as passes complete, the coarse pass (index 0) with the largest regions first
+    orig_h, orig_w = image.shape[:2]
+    cols, rows = tiles
+    small = image
+    if resize_factor != 1.0:
+        small = cv2.resize(image, (int(orig_w * resize_factor), int(orig_h * resize_factor)), interpolation=cv2.INTER_AREA)
+    small_h, small_w = small.shape[:2]
+    small_windows = None if windows is None else np.round(windows * resize_factor).astype(np.int64)
+    tasks = []
+    for core, (x0, y0, x1, y1) in tile_bounds(small_w, small_h, cols, rows, tile_overlap):
+        tile_windows = None if small_windows is None else small_windows - np.array([x0, y0, 0, 0], dtype=np.int64)
+        tasks.append((core, (x0, y0, x1, y1), (small[y0:y1, x0:x1], (x0, y0), engine, 1.0, tile_windows, params)))
+    # Regions spanning several tiles come from one coarse pass over the whole image, at the same pixel budget as a tile
+    coarse_task = (image, (0, 0), engine, resize_factor / max(cols, rows), windows, params)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(tasks) + 1)) as executor:
+        coarse_future = executor.submit(_search_tile, *coarse_task)
+        tile_futures = {executor.submit(_search_tile, *task): (index, core, padded) for index, (core, padded, task) in enumerate(tasks, 1)}
+        yield 0, coarse_future.result()
+        for future in concurrent.futures.as_completed(tile_futures):
+            index, (cx0, cy0, cx1, cy1), padded = tile_futures[future]
+            rects = drop_seam_rects(future.result(), padded, small_w, small_h)
+            # Each tile only owns proposals centred in its core, so seams are not reported twice
+            centers_x = rects[:, 0] + rects[:, 2] // 2
+            centers_y = rects[:, 1] + rects[:, 3] // 2
+            owned = (centers_x >= cx0) & (centers_x < cx1) & (centers_y >= cy0) & (centers_y < cy1)
+            yield index, scale_rects(rects[owned], resize_factor)
+
+def tiled_search(image, tiles, tile_overlap=0.15, workers=None, engine='selective-search', resize_factor=1.0, windows=None, **params):
+    merged = dict(iter_tiled_search(image, tiles, tile_overlap, workers, engine, resize_factor, windows, **params))
+    return np.concatenate([merged[index] for index in sorted(merged)])
+
+RAW_FORMATS = {
+    'bgr': None,
+    'bgra': cv2.COLOR_BGRA2BGR,
+    'rgb': cv2.COLOR_RGB2BGR,
+    'rgba': cv2.COLOR_RGBA2BGR,
+}
+
+def parse_size(value):
+    try:
+        width, height = (int(n) for n in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid size "{value}", expected WIDTHxHEIGHT like 1920x1080')
+    return width, height
+
+def load_raw_image(path, size, pixel_format='bgr'):
+    # Maps raw pixels (e.g. a screenshot already in /dev/shm) without copying or decoding
+    width, height = size
+    try:
+        pixels = np.memmap(path, dtype=np.uint8, mode='r', shape=(height, width, len(pixel_format)))
+    except (OSError, ValueError) as e:
+        print(f'Error: Could not map raw {width}x{height} {pixel_format} image {path}: {e}', file=sys.stderr)
+        sys.exit(1)
+    conversion = RAW_FORMATS[pixel_format]
+    return pixels if conversion is None else cv2.cvtColor(pixels, conversion)
+
+def find_regions(image_path, min_width, min_height, max_width=None, max_height=None, quality=False, k=150, min_size=20, sigma=0.8, resize_factor=1.0, cache_dir=None, windows=None, windows_mode='merge', window_coverage=0.5, tiles=None, tile_overlap=0.15, workers=None, engine='selective-search', flat_regions=False, on_batch=None, image=None, need_image=False):
+    # image: already decoded BGR pixels to use instead of reading image_path
+    # need_image: also decode on a cache hit, so the caller can draw on the original
+    # on_batch, if given, is called with each batch of regions as soon as it is known, largest first.
+    # Batches from a search still in progress are provisional: once it finishes, on_batch(None) says to
+    # drop everything received so far, and the final regions follow (with the windows again, in merge mode)
+    if windows is not None and windows_mode in ('merge', 'only') and on_batch:
+        on_batch(windows)
+    if windows is not None and windows_mode == 'only':
+        # Known windows are all we need, skip decoding and searching entirely
+        return windows, image
+    if image is not None:
+        data = image if image.flags.c_contiguous else np.ascontiguousarray(image)
+    else:
+        try:
+            with open(image_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            data = b''
+    key = cache_key(data, quality, k, min_size, sigma, resize_factor, windows, tiles, tile_overlap, engine, flat_regions) if cache_dir else None
+    cached = load_cached_proposals(cache_dir, key) if key else None
+
+    def decode():
+        decoded = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR) if len(data) else None
+        if decoded is None:
+            print(f'Error: Could not load image {image_path}', file=sys.stderr)
+            sys.exit(1)
+        return decoded
+
+    def postprocess(rects, kept=None):
+        rects = filter_rects(rects, orig_w, orig_h, min_width, min_height, max_width, max_height)
+        if windows is not None and len(windows) and len(rects):
+            rects = rects[covered_fraction(rects, windows, orig_w, orig_h, resize_factor) < window_coverage]
+        # Remove duplicates/overlaps
+        return non_max_suppression(rects, iou_threshold=0.7, kept=kept)
+
+    streamed = None  # Provisional regions already passed to on_batch while searching
+    if cached is not None:
+        rects, (orig_w, orig_h) = cached
+        if image is None and need_image:
+            image = decode()
+    else:
+        if image is None:
+            image = decode()
+        orig_h, orig_w = image.shape[:2]
+        if engine == 'contours':
+            params = dict(flat_regions=flat_regions)
         else:
-            continue
+            params = dict(quality=quality, k=k, min_size=min_size, sigma=sigma)
+        if tiles and on_batch:
+            # Emit each pass as it completes, deduplicated against what was already emitted
+            merged = {}
+            streamed = np.empty((0, 4), dtype=np.int64)
+            for index, batch in iter_tiled_search(image, tiles, tile_overlap, workers, engine, resize_factor, windows, **params):
+                merged[index] = batch
+                batch = postprocess(batch, kept=streamed)
+                streamed = np.concatenate([streamed, batch])
+                on_batch(batch)
+            rects = np.concatenate([merged[index] for index in sorted(merged)])
+        elif tiles:
+            rects = tiled_search(image, tiles, tile_overlap, workers, engine, resize_factor, windows, **params)
+        else:
+            if on_batch:
+                # Quick pass over a quarter of the pixels, so the largest regions show up while the full search runs
+                streamed = postprocess(search_regions(image, engine, resize_factor / 2, windows, **params))
+                on_batch(streamed)
+            rects = search_regions(image, engine, resize_factor, windows, **params)
+        if key:
+            save_cached_proposals(cache_dir, key, rects, (orig_w, orig_h))
+    rects = postprocess(rects)
+    if on_batch:
+        # The final regions are the same whether or not anything was streamed, or cached
+        if streamed is not None:
+            on_batch(None)
+            if windows is not None and windows_mode == 'merge':
+                on_batch(windows)
+        on_batch(rects)
+    if windows is not None and windows_mode == 'merge':
+        rects = np.concatenate([windows, rects])
+    return rects, image  # Original image for drawing, None if served from cache and not needed
+
+def largest_rect(rects):
+    if not len(rects):
+        return rects
+    return rects[[np.argmax(areas(rects))]]
+
+def rects_to_json(rects, hyprctl=False):
+    # Only materialize Python objects at the output boundary
+    if hyprctl:
+        return [{"at": [x, y], "size": [w, h]} for x, y, w, h in rects.tolist()]
+    return [{'x': x, 'y': y, 'width': w, 'height': h} for x, y, w, h in rects.tolist()]
+
+def draw_regions(image, rects, output_path):
+    if not image.flags.writeable:
+        image = image.copy()  # Mapped raw input is read-only
+    for x, y, w, h in rects.tolist():
         cv2.rectangle(image, (x, y), (x + w, y + h), (0, 0, 255), 2)
     cv2.imwrite(output_path, image)
 
 def main():
-    parser = argparse.ArgumentParser(description='Find regions of interest in an image using selective search.')
+    parser = argparse.ArgumentParser(description='Find regions of interest in an image using selective search or contour detection.')
     parser.add_argument('-i', '--image', default=DEFAULT_IMAGE_PATH, help='Path to input image')
+    parser.add_argument('--raw-size', type=parse_size, help='Treat --image as raw pixels of this WIDTHxHEIGHT, mapped instead of decoded')
+    parser.add_argument('--raw-format', choices=list(RAW_FORMATS), default='bgr', help='Channel order of raw pixels (default: bgr)')
     parser.add_argument('-do', '--debug-output', help='Path to save debug image with rectangles')
     parser.add_argument('--min-width', type=int, default=200, help='Minimum width of detected region')
     parser.add_argument('--min-height', type=int, default=100, help='Minimum height of detected region')
     parser.add_argument('--max-width', type=int, help='Maximum width of detected region')
     parser.add_argument('--max-height', type=int, help='Maximum height of detected region')
     parser.add_argument('--single', action='store_true', help='Only output the most likely (largest) region')
+    parser.add_argument('--engine', choices=list(ENGINES), default='selective-search', help='Region proposal engine. contours is much faster and does not need opencv-contrib (default: selective-search)')
+    parser.add_argument('--flat-regions', action='store_true', help='contours engine: also propose areas of uniform color')
     parser.add_argument('--quality', action='store_true', help='Use quality mode for selective search (slower, less sensitive)')
     parser.add_argument('--k', type=int, default=3000, help='Segmentation parameter k (default: 150)')
     parser.add_argument('--min-size', type=int, default=50, help='Segmentation parameter min_size (default: 20)')
     parser.add_argument('--sigma', type=float, default=0.6, help='Segmentation parameter sigma (default: 0.8)')
     parser.add_argument('--resize-factor', type=float, default=0.1, help='Resize factor for input image before processing (default: 1.0, e.g. 0.5 for half size)')
+    parser.add_argument('--tiles', type=parse_tiles, help='Split the image into a COLSxROWS grid of overlapping tiles searched in parallel, e.g. 2x2. Makes higher resize factors affordable')
+    parser.add_argument('--tile-overlap', type=float, default=0.15, help='Fraction of a tile\'s size it extends into its neighbours (default: 0.15)')
+    parser.add_argument('--workers', type=int, help='Worker processes for tiled mode (default: number of cores)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Directory to cache region proposals in, keyed by image content and segmentation parameters')
+    parser.add_argument('--no-cache', action='store_true', help='Always run selective search, ignoring the proposal cache')
+    parser.add_argument('--windows', help='JSON file with known window/layer geometry, as from `hyprctl clients -j` or `hyprctl layers -j` ("-" for stdin). Every entry is used unless filtered with --workspace/--monitor')
+    parser.add_argument('--workspace', type=int, help='Only use windows on this workspace id, e.g. the active one of the monitor')
+    parser.add_argument('--monitor', help='Only use layers on this monitor name')
+    parser.add_argument('--windows-mode', choices=['merge', 'exclude', 'only'], default='merge', help='merge: output windows plus proposals outside them, exclude: only proposals outside windows, only: skip selective search and output windows')
+    parser.add_argument('--window-coverage', type=float, default=0.5, help='Drop proposals with at least this fraction of their area under a known window (default: 0.5)')
+    parser.add_argument('--offset-x', type=int, default=0, help='Subtracted from window x coordinates, e.g. the monitor x position')
+    parser.add_argument('--offset-y', type=int, default=0, help='Subtracted from window y coordinates, e.g. the monitor y position')
+    parser.add_argument('--stream', action='store_true', help='Print one JSON region per line as soon as it is found, largest first, instead of a single array. A {"reset": true} line means the regions before it were provisional and the final ones follow. Ignored with --single')
     parser.add_argument('--hyprctl', action='store_true', help='Mimics hyprctl\'s window output, like {"at": [x, y], "size": [w, h]}')
     args = parser.parse_args()
+    windows = load_windows(args.windows, args.offset_x, args.offset_y, args.workspace, args.monitor) if args.windows else None
+    raw_image = load_raw_image(args.image, args.raw_size, args.raw_format) if args.raw_size else None
+
+    def print_batch(rects):
+        if rects is None:
+            # Regions printed so far were provisional, the final ones follow
+            print(json.dumps({'reset': True}))
+            sys.stdout.flush()
+            return
+        for region in rects_to_json(rects, hyprctl=args.hyprctl):
+            print(json.dumps(region))
+        sys.stdout.flush()
 
-    regions, image = find_regions(
+    rects, image = find_regions(
         args.image,
         min_width=args.min_width,
         min_height=args.min_height,
@@ -104,16 +452,28 @@ def main():
         k=args.k,
         min_size=args.min_size,
         sigma=args.sigma,
-        resize_factor=args.resize_factor
+        resize_factor=args.resize_factor,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        windows=windows,
+        windows_mode=args.windows_mode,
+        window_coverage=args.window_coverage,
+        tiles=args.tiles,
+        tile_overlap=args.tile_overlap,
+        workers=args.workers,
+        engine=args.engine,
+        flat_regions=args.flat_regions,
+        on_batch=print_batch if args.stream and not args.single else None,
+        image=raw_image,
+        need_image=bool(args.debug_output)
     )
-    if args.single and regions:
-        largest = max(regions, key=lambda r: r['width'] * r['height'])
-        regions = [largest]
-    if args.hyprctl:
-        regions = [{"at": [r['x'], r['y']], "size": [r['width'], r['height']]} for r in regions]
-    print(json.dumps(regions))
+    if args.single:
+        rects = largest_rect(rects)
+    if not args.stream or args.single:
+        print(json.dumps(rects_to_json(rects, hyprctl=args.hyprctl)))
     if args.debug_output:
-        draw_regions(image, regions, args.debug_output)
+        if image is None:
+            image = cv2.imread(args.image)  # Only with --windows-mode only, nothing was decoded
+        draw_regions(image, rects, args.debug_output)
 
 if __name__ == '__main__':
     main()
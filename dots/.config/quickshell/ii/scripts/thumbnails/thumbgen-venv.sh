@@ -2,8 +2,5 @@
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 
 source $(eval echo $ILLOGICAL_IMPULSE_VIRTUAL_ENV)/bin/activate
-GIO_USE_VFS=local "$SCRIPT_DIR/thumbgen.py" "$@"
-THUMBGEN_EXIT_CODE=$?
-deactivate
-
-exit $THUMBGEN_EXIT_CODE
+# exec, so signals to this script (like the shell stopping a --watch run) reach thumbgen itself
+GIO_USE_VFS=local exec "$SCRIPT_DIR/thumbgen.py" "$@"
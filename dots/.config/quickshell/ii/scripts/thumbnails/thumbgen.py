@@ -4,115 +4,744 @@
 # Since the script is small and the maintainers seem inactive to accept my PR (#11) I decided to just copy it over.
 # When it gets merged and the python package gets updated we can just use it
 
+import ctypes
+import hashlib
+import heapq
+import io
+import itertools
+import json
 import os
+import queue
+import select
+import signal
+import struct
+import subprocess
 import sys
+import threading
+import time
+from collections import Counter
 from multiprocessing import Pool
 from pathlib import Path
-from typing import List, Union
+from typing import Dict, Iterator, List, Tuple, Union
+from urllib.parse import quote
 
 import click
-import gi
 from loguru import logger
 from tqdm import tqdm
 
-gi.require_version("GnomeDesktop", "4.0")
-from gi.repository import Gio, GnomeDesktop  # isort:skip
+try:
+    import gi
+    gi.require_version("GnomeDesktop", "4.0")
+    from gi.repository import GdkPixbuf, Gio, GLib, GnomeDesktop  # isort:skip
+    GNOME_DESKTOP_AVAILABLE = True
+except (ImportError, ValueError):
+    GNOME_DESKTOP_AVAILABLE = False
 
-thumbnail_size_map = {
-    "normal": GnomeDesktop.DesktopThumbnailSize.NORMAL,
-    "large": GnomeDesktop.DesktopThumbnailSize.LARGE,
-    "x-large": GnomeDesktop.DesktopThumbnailSize.XLARGE,
-    "xx-large": GnomeDesktop.DesktopThumbnailSize.XXLARGE,
+try:
+    from PIL import Image, ImageOps, PngImagePlugin
+    PILLOW_AVAILABLE = True
+except ImportError:
+    PILLOW_AVAILABLE = False
+
+# Freedesktop thumbnail sizes, in pixels
+THUMBNAIL_SIZES = {
+    "normal": 128,
+    "large": 256,
+    "x-large": 512,
+    "xx-large": 1024,
 }
 
-factory = None
+if GNOME_DESKTOP_AVAILABLE:
+    thumbnail_size_map = {
+        "normal": GnomeDesktop.DesktopThumbnailSize.NORMAL,
+        "large": GnomeDesktop.DesktopThumbnailSize.LARGE,
+        "x-large": GnomeDesktop.DesktopThumbnailSize.XLARGE,
+        "xx-large": GnomeDesktop.DesktopThumbnailSize.XXLARGE,
+    }
+
+CACHE_HOME = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+THUMBNAIL_CACHE_DIR = CACHE_HOME / "thumbnails"
+# Per application negative caches from the spec: ours, plus the one GnomeDesktop writes on its own
+FAILED_THUMBNAIL_DIRS = (THUMBNAIL_CACHE_DIR / "fail" / "quickshell-thumbgen", THUMBNAIL_CACHE_DIR / "fail" / "gnome-thumbnail-factory")
+SCAN_MANIFEST_PATH = CACHE_HOME / "quickshell" / "thumbgen" / "scan_manifest.json"
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".gif"}
+VIDEO_SUFFIXES = {".mp4", ".webm", ".mkv", ".avi", ".mov"}
+# How far into a video (or animation) the thumbnail frame is taken, past intros and fades from black
+REPRESENTATIVE_POSITION = 0.1
+FFMPEG_TIMEOUT = 30
+# Results reported for a file (failed_before: skipped, it failed earlier and did not change), and the ones worth naming in the log
+STATUSES = ("ok", "fresh", "unsupported", "error", "failed_before")
+FAILED_STATUSES = ("unsupported", "error")
+# Seconds between machine progress lines, however fast files complete
+PROGRESS_INTERVAL = 0.25
+# Characters g_filename_to_uri leaves unescaped in paths, so our URIs (and their md5) match GLib's
+URI_SAFE_CHARS = "/!$&'()*+,:=@"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+# From <sys/prctl.h>
+PR_SET_PDEATHSIG = 1
+
+# Per worker process state, set up by init_worker so no GI state is inherited through fork
+backend = None
+factories = {}
 logger.remove()
 logger.add(sys.stdout, level="INFO")
 logger.add("/tmp/thumbgen.log", level="DEBUG", rotation="100 MB")
 
-def make_thumbnail(fpath: str) -> bool:
-    mtime = os.path.getmtime(fpath)
+def init_worker(sizes: Tuple[str, ...], backend_name: str) -> None:
+    global backend, factories
+    backend = backend_name
+    if backend == "gnome":
+        factories = {size: GnomeDesktop.DesktopThumbnailFactory.new(thumbnail_size_map[size]) for size in sizes}
+
+
+def largest_first(sizes) -> Tuple[str, ...]:
+    return tuple(sorted(set(sizes), key=THUMBNAIL_SIZES.get, reverse=True))
+
+
+def resolve_backend(name: str) -> str:
+    if name == "auto":
+        name = "gnome" if GNOME_DESKTOP_AVAILABLE else "pillow"
+    if name == "gnome" and not GNOME_DESKTOP_AVAILABLE:
+        raise click.UsageError("GnomeDesktop 4.0 is not available through GI, try --backend pillow")
+    if name == "pillow" and not PILLOW_AVAILABLE:
+        raise click.UsageError("Pillow is not installed")
+    return name
+
+
+def make_thumbnail(job: Tuple[str, Tuple[str, ...]]) -> Tuple[str, str]:
+    # job is (path, sizes to generate, largest first); every size comes from a single decode
+    fpath, sizes = job
+    # GnomeDesktop only handles videos when a thumbnailer like ffmpegthumbnailer is installed, ours only needs ffmpeg
+    try:
+        if backend == "gnome" and not (PILLOW_AVAILABLE and is_video(fpath)):
+            return make_thumbnail_gnome(fpath, sizes)
+        return make_thumbnail_pillow(fpath, sizes)
+    except Exception:
+        # Anything unexpected is this file's error; raised, it would end the whole batch (or the watcher)
+        logger.opt(exception=True).debug("Thumbnailing {} failed".format(fpath))
+        return fpath, "error"
+
+
+def make_thumbnail_gnome(fpath: str, sizes: Tuple[str, ...]) -> Tuple[str, str]:
     # Use Gio to determine the URI and mime type
     f = Gio.file_new_for_path(str(fpath))
     uri = f.get_uri()
-    info = f.query_info("standard::content-type", Gio.FileQueryInfoFlags.NONE, None)
+    try:
+        mtime = os.path.getmtime(fpath)
+        info = f.query_info("standard::content-type", Gio.FileQueryInfoFlags.NONE, None)
+    except (OSError, GLib.Error):
+        # Removed or unreadable since it was listed
+        return fpath, "error"
     mime_type = info.get_content_type()
 
-    if factory.lookup(uri, mtime) is not None:
-        logger.debug("FRESH       {}".format(uri))
-        return False
+    sizes = tuple(size for size in sizes if factories[size].lookup(uri, mtime) is None)
+    if not sizes:
+        return fpath, "fresh"
 
-    if not factory.can_thumbnail(uri, mime_type, mtime):
-        logger.debug("UNSUPPORTED {}".format(uri))
-        return False
+    if not factories[sizes[0]].can_thumbnail(uri, mime_type, mtime):
+        save_failed_thumbnail(uri, mtime)
+        return fpath, "unsupported"
 
-    thumbnail = factory.generate_thumbnail(uri, mime_type)
+    thumbnail = factories[sizes[0]].generate_thumbnail(uri, mime_type)
     if thumbnail is None:
-        logger.debug("ERROR       {}".format(uri))
+        save_failed_thumbnail(uri, mtime)
+        return fpath, "error"
+
+    for size in sizes:
+        # Each smaller size is scaled down from the previous one rather than regenerated from the source
+        scale = THUMBNAIL_SIZES[size] / max(thumbnail.get_width(), thumbnail.get_height())
+        if scale < 1:
+            thumbnail = thumbnail.scale_simple(
+                max(1, round(thumbnail.get_width() * scale)),
+                max(1, round(thumbnail.get_height() * scale)),
+                GdkPixbuf.InterpType.BILINEAR,
+            )
+        factories[size].save_thumbnail(thumbnail, uri, mtime)
+    return fpath, "ok"
+
+
+def save_failed_thumbnail(uri: str, mtime: float) -> None:
+    # An empty PNG carrying the source's URI and mtime; the file is skipped until it changes
+    path = FAILED_THUMBNAIL_DIRS[0] / (hashlib.md5(uri.encode()).hexdigest() + ".png")
+    text = {"Thumb::URI": uri, "Thumb::MTime": str(int(mtime)), "Software": "quickshell thumbgen"}
+    try:
+        if backend == "gnome":
+            path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            tmp_path = path.with_name(".{}.{}.tmp".format(path.name, os.getpid()))
+            pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8, 1, 1)
+            pixbuf.savev(str(tmp_path), "png", ["tEXt::" + key for key in text], list(text.values()))
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, path)
+        else:
+            save_thumbnail_png(Image.new("RGBA", (1, 1)), path, text)
+    except OSError as e:
+        logger.warning("Could not record failure for {}: {}".format(uri, e))
+
+
+def save_thumbnail_png(image: "Image.Image", path: Path, text: Dict[str, str]) -> None:
+    # Written next to the target and renamed, so readers never see a partial thumbnail
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    pnginfo = PngImagePlugin.PngInfo()
+    for key, value in text.items():
+        pnginfo.add_text(key, value)
+    tmp_path = path.with_name(".{}.{}.tmp".format(path.name, os.getpid()))
+    try:
+        image.save(tmp_path, "PNG", pnginfo=pnginfo)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def probe_duration(fpath: str) -> float:
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", fpath],
+        capture_output=True, text=True, timeout=FFMPEG_TIMEOUT,
+    )
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return 0.0
+
+
+def grab_video_frame(fpath: str, pixels: int) -> Tuple["Image.Image", float]:
+    # Seeks before opening the input so ffmpeg jumps straight to a keyframe, then decodes only keyframes
+    # and lets the thumbnail filter pick the most representative of a few. The frame comes back already
+    # scaled to the largest size, so no full resolution frame crosses the pipe
+    duration = probe_duration(fpath)
+    result = subprocess.run(
+        [
+            "ffmpeg", "-nostdin", "-v", "error",
+            "-ss", "{:.3f}".format(duration * REPRESENTATIVE_POSITION), "-skip_frame", "nokey", "-i", fpath,
+            "-an", "-sn", "-dn", "-frames:v", "1",
+            "-vf", "thumbnail=8,scale={0}:{0}:force_original_aspect_ratio=decrease".format(pixels),
+            "-f", "image2pipe", "-c:v", "png", "-",
+        ],
+        capture_output=True, check=True, timeout=FFMPEG_TIMEOUT,
+    )
+    image = Image.open(io.BytesIO(result.stdout))
+    image.load()
+    return image, duration
+
+
+def make_thumbnail_pillow(fpath: str, sizes: Tuple[str, ...]) -> Tuple[str, str]:
+    if is_video(fpath):
+        return make_thumbnail_video(fpath, sizes)
+    uri = path_to_uri(fpath)
+    try:
+        st = os.stat(fpath)
+    except OSError:
+        # Removed or unreadable since it was listed
+        return fpath, "error"
+
+    pixels = THUMBNAIL_SIZES[sizes[0]]
+    try:
+        with Image.open(fpath) as image:
+            width, height = image.size
+            # JPEG only: let the decoder downscale in the DCT domain instead of decoding every pixel
+            image.draft("RGB", (pixels, pixels))
+            if getattr(image, "is_animated", False):
+                image.seek(int(image.n_frames * REPRESENTATIVE_POSITION))
+            image = ImageOps.exif_transpose(image)
+            image.load()
+            has_alpha = "A" in image.getbands() or "transparency" in image.info
+            image = image.convert("RGBA" if has_alpha else "RGB")
+    except Image.UnidentifiedImageError:
+        save_failed_thumbnail(uri, st.st_mtime)
+        return fpath, "unsupported"
+    except (OSError, ValueError, Image.DecompressionBombError):
+        save_failed_thumbnail(uri, st.st_mtime)
+        return fpath, "error"
+
+    text = {
+        "Thumb::URI": uri,
+        "Thumb::MTime": str(int(st.st_mtime)),
+        "Thumb::Size": str(st.st_size),
+        "Thumb::Image::Width": str(width),
+        "Thumb::Image::Height": str(height),
+        "Software": "quickshell thumbgen",
+    }
+    save_thumbnail_sizes(image, uri, sizes, text)
+    return fpath, "ok"
+
+
+def make_thumbnail_video(fpath: str, sizes: Tuple[str, ...]) -> Tuple[str, str]:
+    uri = path_to_uri(fpath)
+    try:
+        st = os.stat(fpath)
+    except OSError:
+        return fpath, "error"
+    try:
+        image, duration = grab_video_frame(fpath, THUMBNAIL_SIZES[sizes[0]])
+    except FileNotFoundError:
+        # Not recorded as a failure: the file is fine, it can be retried once ffmpeg is installed
+        return fpath, "unsupported"
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+        save_failed_thumbnail(uri, st.st_mtime)
+        return fpath, "error"
+
+    text = {
+        "Thumb::URI": uri,
+        "Thumb::MTime": str(int(st.st_mtime)),
+        "Thumb::Size": str(st.st_size),
+        "Thumb::Movie::Length": str(int(duration)),
+        "Software": "quickshell thumbgen",
+    }
+    save_thumbnail_sizes(image.convert("RGB"), uri, sizes, text)
+    return fpath, "ok"
+
+
+def save_thumbnail_sizes(image: "Image.Image", uri: str, sizes: Tuple[str, ...], text: Dict[str, str]) -> None:
+    for size in sizes:
+        # Successive downscaling: each size starts from the previous, already small, image
+        pixels = THUMBNAIL_SIZES[size]
+        image.thumbnail((pixels, pixels))
+        save_thumbnail_png(image, get_thumbnail_path(uri, size), text)
+
+
+def path_to_uri(fpath: str) -> str:
+    # Bytes, so names that are not valid UTF-8 are percent-encoded like GLib does instead of failing
+    return "file://" + quote(os.fsencode(os.path.abspath(fpath)), safe=URI_SAFE_CHARS)
+
+
+def get_thumbnail_path(uri: str, size: str) -> Path:
+    return THUMBNAIL_CACHE_DIR / size / (hashlib.md5(uri.encode()).hexdigest() + ".png")
+
+
+def read_png_text(path: Path) -> Dict[str, str]:
+    # Walks the chunk headers, seeking over the data, and collects the tEXt chunks
+    text = {}
+    with open(path, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return text
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack(">I4s", header)
+            if chunk_type == b"IEND":
+                break
+            if chunk_type == b"tEXt":
+                key, _, value = f.read(length).partition(b"\0")
+                text[key.decode("latin-1")] = value.decode("latin-1")
+                f.seek(4, os.SEEK_CUR)  # CRC
+            else:
+                f.seek(length + 4, os.SEEK_CUR)
+    return text
+
+
+def is_valid_for(thumbnail_path: Path, fpath: str) -> bool:
+    # Same test as DesktopThumbnailFactory.lookup, without GI or a worker round trip
+    try:
+        mtime = int(os.stat(fpath).st_mtime)
+        text = read_png_text(thumbnail_path)
+    except OSError:
         return False
+    return text.get("Thumb::URI") == path_to_uri(fpath) and text.get("Thumb::MTime") == str(mtime)
+
+
+def is_fresh(fpath: str, size: str) -> bool:
+    return is_valid_for(get_thumbnail_path(path_to_uri(fpath), size), fpath)
+
 
-    logger.debug("OK          {}".format(uri))
-    factory.save_thumbnail(thumbnail, uri, mtime)
-    return True
+def has_failed(fpath: str) -> bool:
+    name = hashlib.md5(path_to_uri(fpath).encode()).hexdigest() + ".png"
+    return any(is_valid_for(fail_dir / name, fpath) for fail_dir in FAILED_THUMBNAIL_DIRS)
+
+
+def get_chunksize(*, total: int, workers: int) -> int:
+    # A few chunks per worker keeps them all busy while cutting per-file IPC round trips
+    return max(1, min(32, total // (workers * 4)))
+
+
+def make_jobs(all_files: List[str], sizes: Tuple[str, ...], retry_failed: bool = False) -> List[Tuple[str, Tuple[str, ...]]]:
+    jobs = []
+    failed = 0
+    for fpath in all_files:
+        stale_sizes = tuple(size for size in sizes if not is_fresh(fpath, size))
+        if not stale_sizes:
+            continue
+        if not retry_failed and has_failed(fpath):
+            failed += 1
+            continue
+        jobs.append((fpath, stale_sizes))
+    print("{} files up to date, {} failed before and unchanged, {} to generate".format(len(all_files) - len(jobs) - failed, failed, len(jobs)))
+    return jobs
+
+
+class Progress:
+    # Tallies completed files by status and reports them in batches: a JSON line at most every
+    # PROGRESS_INTERVAL with --machine_progress (a progress bar otherwise), and one log entry per batch.
+    # Completion order does not matter, so it works with imap_unordered and the queue alike
+    def __init__(self, total: int, *, machine_progress: bool) -> None:
+        self.total = total
+        self.machine_progress = machine_progress
+        self.completed = 0
+        self.statuses = dict.fromkeys(STATUSES, 0)
+        self.batch = []  # (path, status) since the last report
+        self.start = self.last_report = time.monotonic()
+        self.bar = None if machine_progress else tqdm(total=total)
+
+    def add(self, fpath: str, status: str) -> None:
+        self.completed += 1
+        self.statuses[status] += 1
+        self.batch.append((fpath, status))
+        if self.bar is not None:
+            self.bar.total = self.total  # The queue keeps growing it
+            self.bar.update()
+        if time.monotonic() - self.last_report >= PROGRESS_INTERVAL:
+            self.report()
+
+    def report(self) -> None:
+        if not self.batch:
+            return
+        now = time.monotonic()
+        elapsed = now - self.start
+        rate = self.completed / elapsed if elapsed > 0 else 0.0
+        if self.machine_progress:
+            print(json.dumps({
+                "completed": self.completed,
+                "total": self.total,
+                "statuses": self.statuses,
+                "files_per_second": round(rate, 2),
+                "eta_seconds": round((self.total - self.completed) / rate, 1) if rate > 0 else None,
+                "generated": [fpath for fpath, status in self.batch if status == "ok"],
+            }))
+            sys.stdout.flush()
+        counts = Counter(status for _, status in self.batch)
+        failures = ["\n  {:<11} {}".format(status.upper(), fpath) for fpath, status in self.batch if status in FAILED_STATUSES]
+        logger.debug("{} files: {}{}".format(len(self.batch), ", ".join("{} {}".format(n, status) for status, n in counts.items()), "".join(failures)))
+        self.batch = []
+        self.last_report = now
+
+    def close(self) -> None:
+        self.report()
+        if self.bar is not None:
+            self.bar.close()
+
+
+def run_jobs(jobs: List[Tuple[str, Tuple[str, ...]]], *, sizes: Tuple[str, ...], backend: str, workers: int, machine_progress: bool = False) -> None:
+    if not jobs:
+        return
+    total = len(jobs)
+    workers = max(1, min(workers, total))
+    chunksize = get_chunksize(total=total, workers=workers)
+    start = time.perf_counter()
+    with Pool(processes=workers, initializer=init_worker, initargs=(sizes, backend)) as p:
+        progress = Progress(total, machine_progress=machine_progress)
+        for fpath, status in p.imap_unordered(make_thumbnail, jobs, chunksize=chunksize):
+            progress.add(fpath, status)
+        progress.close()
+    elapsed = time.perf_counter() - start
+    print("Processed {} files in {:.2f}s ({:.1f} files/s) with {} workers".format(total, elapsed, total / elapsed if elapsed > 0 else 0, workers))
+
+
+@logger.catch()
+def thumbnail_folder(*, dir_path: Path, sizes: Tuple[str, ...], backend: str, workers: int, only_images: bool, recursive: bool, machine_progress: bool = False, use_manifest: bool = True, retry_failed: bool = False) -> None:
+    all_files = get_all_files(dir_path=dir_path, recursive=recursive, only_images=only_images, use_manifest=use_manifest)
+    sizes = largest_first(sizes)
+    run_jobs(make_jobs(all_files, sizes, retry_failed=retry_failed), sizes=sizes, backend=backend, workers=workers, machine_progress=machine_progress)
+
+
+@logger.catch()
+def thumbnail_files(*, fpaths: Tuple[str, ...], sizes: Tuple[str, ...], backend: str, workers: int) -> bool:
+    # For scripts that need one thumbnail now: prints "THUMBNAIL <path>" (largest size) for each file that has one
+    sizes = largest_first(sizes)
+    fpaths = [os.path.abspath(fpath) for fpath in fpaths]
+    # Asked for by name, so earlier failures are tried again
+    run_jobs(make_jobs(fpaths, sizes, retry_failed=True), sizes=sizes, backend=backend, workers=workers, machine_progress=True)
+    ok = True
+    for fpath in fpaths:
+        if is_fresh(fpath, sizes[0]):
+            print("THUMBNAIL {}".format(get_thumbnail_path(path_to_uri(fpath), sizes[0])))
+        else:
+            ok = False
+    return ok
+
+
+def add_watches(libc: ctypes.CDLL, fd: int, dir_path: str, *, recursive: bool, watches: Dict[int, str]) -> List[str]:
+    # Watches dir_path (and its subdirectories if recursive), returns the files already in them
+    wd = libc.inotify_add_watch(fd, os.fsencode(dir_path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR)
+    if wd < 0:
+        logger.warning("Could not watch {}: {}".format(dir_path, os.strerror(ctypes.get_errno())))
+        return []
+    watches[wd] = dir_path
+    files = []
+    try:
+        with os.scandir(dir_path) as it:
+            for dirent in it:
+                if dirent.is_file():
+                    files.append(dirent.path)
+                elif recursive and dirent.is_dir(follow_symlinks=False):
+                    files.extend(add_watches(libc, fd, dirent.path, recursive=recursive, watches=watches))
+    except OSError:
+        pass
+    return files
+
+
+@logger.catch()
+def watch_folders(*, dir_paths: List[Path], sizes: Tuple[str, ...], backend: str, workers: int, only_images: bool, recursive: bool, machine_progress: bool = False, debounce: float = 1.0) -> None:
+    # Thumbnails files as they are created or modified, batching bursts (like a bulk copy) until things settle for `debounce` seconds
+    libc = ctypes.CDLL(None, use_errno=True)
+    # Long-lived: go away with whoever started us instead of lingering on a closed stdout
+    libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    fd = libc.inotify_init1(IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    sizes = largest_first(sizes)
+    roots = [os.path.abspath(dir_path) for dir_path in dir_paths]
+    watches = {}
+    for root in roots:
+        add_watches(libc, fd, root, recursive=recursive, watches=watches)
+    pending = {}  # Insertion-ordered set of paths
+    last_event = 0.0
+    while True:
+        timeout = max(0.0, last_event + debounce - time.monotonic()) if pending else None
+        readable, _, _ = select.select([fd], [], [], timeout)
+        if not readable:
+            files = [fpath for fpath in pending if os.path.isfile(fpath) and (not only_images or is_image(fpath))]
+            pending.clear()
+            try:
+                run_jobs(make_jobs(files, sizes), sizes=sizes, backend=backend, workers=workers, machine_progress=machine_progress)
+            except Exception:
+                # One bad batch must not end the watch; its files come back on their next change
+                logger.exception("Thumbnail batch failed")
+            print("IDLE")
+            sys.stdout.flush()
+            continue
+        data = os.read(fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + name_length].rstrip(b"\0")
+            offset += INOTIFY_EVENT.size + name_length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, fall back to a listing of everything
+                for root in roots:
+                    pending.update(dict.fromkeys(get_all_files(dir_path=Path(root), recursive=recursive)))
+                continue
+            if mask & IN_IGNORED:
+                watches.pop(wd, None)
+                continue
+            dir_path = watches.get(wd)
+            if dir_path is None:
+                continue
+            fpath = os.path.join(dir_path, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    pending.update(dict.fromkeys(add_watches(libc, fd, fpath, recursive=recursive, watches=watches)))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                pending[fpath] = None
+        last_event = time.monotonic()
+
+
+def read_queue_requests(events: "queue.Queue") -> None:
+    # Runs in a thread: forwards "<priority> <path>" lines from stdin as events
+    for line in sys.stdin:
+        line = line.rstrip("\n")
+        if not line.strip():
+            continue
+        priority, _, fpath = line.partition(" ")
+        try:
+            events.put(("push", (float(priority), fpath)))
+        except ValueError:
+            events.put(("push", (0.0, line)))  # No priority given, treat it as urgent
+    events.put(("eof", None))
 
 
 @logger.catch()
-def thumbnail_folder(*, dir_path: Path, workers: int, only_images: bool, recursive: bool, machine_progress: bool = False) -> None:
-    all_files = get_all_files(dir_path=dir_path, recursive=recursive)
-    if only_images:
-        all_files = get_all_images(all_files=all_files)
-    all_files = [str(fpath) for fpath in all_files]
-    if machine_progress:
-        completed = 0
-        total = len(all_files)
-        with Pool(processes=workers) as p:
-            for result in p.imap(make_thumbnail, all_files):
-                completed += 1
-                print(f"PROGRESS {completed}/{total} FILE {all_files[completed-1]}")
-                sys.stdout.flush()
-    else:
-        with Pool(processes=workers) as p:
-            list(tqdm(p.imap(make_thumbnail, all_files), total=len(all_files)))
-
-
-def get_all_images(*, all_files: List[Path]) -> List[Path]:
-    img_suffixes = [".jpg", ".jpeg", ".png", ".gif"]
-    all_images = [fpath for fpath in all_files if fpath.suffix in img_suffixes]
-    print("Found {} images".format(len(all_images)))
-    return all_images
-
-
-def get_all_files(*, dir_path: Path, recursive: bool) -> List[Path]:
+def serve_queue(*, dir_paths: List[Path], sizes: Tuple[str, ...], backend: str, workers: int, only_images: bool, recursive: bool, machine_progress: bool = False, background_priority: float = 100.0, retry_failed: bool = False) -> None:
+    # Lower priorities are thumbnailed first. Pushing a path again while it waits changes its priority,
+    # while it is being thumbnailed does nothing
+    sizes = largest_first(sizes)
+    events = queue.Queue()
+    heap = []
+    waiting = {}  # path -> its live heap entry, older entries for the same path are skipped
+    in_flight = set()
+    counter = itertools.count()
+    progress = Progress(0, machine_progress=machine_progress)
+
+    def push(priority: float, fpath: str) -> None:
+        fpath = os.path.abspath(fpath)
+        if fpath in in_flight:
+            return
+        if fpath not in waiting:
+            progress.total += 1
+        entry = [priority, next(counter), fpath]
+        waiting[fpath] = entry
+        heapq.heappush(heap, entry)
+
+    for dir_path in dir_paths:
+        for fpath in get_all_files(dir_path=dir_path, recursive=recursive, only_images=only_images):
+            push(background_priority, fpath)
+
+    # Only a couple of jobs per worker are handed out at a time, so late high-priority pushes overtake the backlog
+    max_in_flight = workers * 2
+    stdin_open = True
+    with Pool(processes=workers, initializer=init_worker, initargs=(sizes, backend)) as p:
+        # Started after the fork: workers close their inherited stdin, which would block on the reader's lock
+        threading.Thread(target=read_queue_requests, args=(events,), daemon=True).start()
+        while True:
+            while heap and len(in_flight) < max_in_flight:
+                _, _, fpath = entry = heapq.heappop(heap)
+                if waiting.get(fpath) is not entry:
+                    continue
+                del waiting[fpath]
+                stale_sizes = tuple(size for size in sizes if not is_fresh(fpath, size))
+                if not stale_sizes:
+                    events.put(("done", (fpath, "fresh")))
+                elif not retry_failed and has_failed(fpath):
+                    events.put(("done", (fpath, "failed_before")))
+                else:
+                    p.apply_async(make_thumbnail, ((fpath, stale_sizes),), callback=lambda result: events.put(("done", result)), error_callback=lambda e, fpath=fpath: events.put(("done", (fpath, "error"))))
+                in_flight.add(fpath)
+            if not stdin_open and not heap and not in_flight:
+                break
+            try:
+                kind, payload = events.get(timeout=PROGRESS_INTERVAL)
+            except queue.Empty:
+                # Nothing finished for a while, don't sit on the last results
+                progress.report()
+                continue
+            if kind == "push":
+                push(*payload)
+            elif kind == "eof":
+                stdin_open = False
+            elif kind == "done":
+                in_flight.discard(payload[0])
+                progress.add(*payload)
+    progress.close()
+    print("Processed {} files".format(progress.completed))
+
+
+def is_image(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in IMAGE_SUFFIXES
+
+
+def is_video(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in VIDEO_SUFFIXES
+
+
+def load_scan_manifest() -> Dict[str, dict]:
+    try:
+        return json.loads(SCAN_MANIFEST_PATH.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_scan_manifest(manifest: Dict[str, dict]) -> None:
+    try:
+        SCAN_MANIFEST_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = SCAN_MANIFEST_PATH.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(manifest))
+        os.replace(tmp_path, SCAN_MANIFEST_PATH)
+    except OSError as e:
+        logger.warning("Could not save scan manifest: {}".format(e))
+
+
+def scan_dir(dir_path: str, *, recursive: bool, only_images: bool, manifest: Dict[str, dict], scanned: Dict[str, dict]) -> Iterator[str]:
+    # Directories whose mtime matches the manifest are not listed again, their entries come from the manifest.
+    # The manifest keeps every file name, so it serves runs with and without only_images alike
+    try:
+        mtime_ns = os.stat(dir_path).st_mtime_ns
+    except OSError:
+        return
+    entry = manifest.get(dir_path)
+    if entry is None or entry["mtime_ns"] != mtime_ns:
+        entry = {"mtime_ns": mtime_ns, "files": [], "dirs": []}
+        try:
+            with os.scandir(dir_path) as it:
+                for dirent in it:
+                    # Dirent type info, no extra stat unless the entry is a symlink
+                    if dirent.is_file():
+                        entry["files"].append(dirent.name)
+                    elif dirent.is_dir(follow_symlinks=False):
+                        entry["dirs"].append(dirent.name)
+        except OSError:
+            return
+    scanned[dir_path] = entry
+    for name in entry["files"]:
+        if not only_images or is_image(name):
+            yield os.path.join(dir_path, name)
+    if recursive:
+        for name in entry["dirs"]:
+            yield from scan_dir(os.path.join(dir_path, name), recursive=recursive, only_images=only_images, manifest=manifest, scanned=scanned)
+
+
+def get_all_files(*, dir_path: Path, recursive: bool, only_images: bool = False, use_manifest: bool = True) -> List[str]:
     if not (dir_path.exists() and dir_path.is_dir()):
         raise ValueError("{} doesn't exist or isn't a valid directory!".format(dir_path.resolve()))
+    root = os.path.abspath(dir_path)
+    manifest = load_scan_manifest() if use_manifest else {}
+    scanned = {}
+    all_files = list(scan_dir(root, recursive=recursive, only_images=only_images, manifest=manifest, scanned=scanned))
     if recursive:
-        all_files = dir_path.rglob("*")
-    else:
-        all_files = dir_path.glob("*")
-    all_files = [fpath for fpath in all_files if fpath.is_file()]
-    print("Found {} files in the directory: {}".format(len(all_files), dir_path.resolve()))
+        # Replace this tree's entries so deleted directories don't linger
+        prefix = os.path.join(root, "")
+        manifest = {path: entry for path, entry in manifest.items() if not path.startswith(prefix)}
+    manifest.update(scanned)
+    save_scan_manifest(manifest)
+    print("Found {} {} in the directory: {}".format(len(all_files), "images" if only_images else "files", root))
     return all_files
 
 @click.command()
 @click.option(
-    "-d", "--img_dirs", required=True, help='directories to generate thumbnails seperated by space, eg: "dir1/dir2 dir3"'
+    "-d", "--img_dirs", default="", help='directories to generate thumbnails seperated by space, eg: "dir1/dir2 dir3"'
+)
+@click.option(
+    "-s", "--size", "sizes", default=["normal"], multiple=True, type=click.Choice(list(THUMBNAIL_SIZES)), help="Thumbnail size: normal, large, x-large, xx-large. Repeat to generate several sizes from one decode"
 )
 @click.option(
-    "-s", "--size", default="normal", type=click.Choice(["normal", "large", "x-large", "xx-large"]), help="Thumbnail size: normal, large, x-large, xx-large"
+    "-b", "--backend", default="auto", type=click.Choice(["auto", "gnome", "pillow"]), help="Thumbnailer: GnomeDesktop via GI, or the built-in Pillow one. auto prefers gnome when available"
 )
-@click.option("-w", "--workers", default=1, help="no of cpus to use for processing")
+@click.option("-w", "--workers", default=os.cpu_count() or 1, type=int, help="no of cpus to use for processing, defaults to all cores")
 @click.option(
     "-i", "--only_images", is_flag=True, default=False, help="Whether to only look for images to be thumbnailed"
 )
+@click.option("-f", "--file", "files", multiple=True, help='Thumbnail this file and print "THUMBNAIL <path>" for it. Repeatable, exits with 1 if any failed')
 @click.option("-r", "--recursive", is_flag=True, default=False, help="Whether to recursively look for files")
+@click.option("--rescan", is_flag=True, default=False, help="List every directory again instead of trusting the scan manifest")
+@click.option("--retry_failed", is_flag=True, default=False, help="Try again files that failed before, even if they did not change since")
+@click.option("--watch", is_flag=True, default=False, help="Keep running and thumbnail files as they are created or modified, printing IDLE after each batch")
+@click.option("--debounce", default=1.0, type=float, help="With --watch, seconds without new events before a batch is processed")
+@click.option("--queue", "use_queue", is_flag=True, default=False, help='Also read "<priority> <path>" lines from stdin, lowest priority first. Pushing a waiting path again re-prioritizes it, pushing one in progress does nothing')
+@click.option("--background_priority", default=100.0, type=float, help="With --queue, priority of the files found in --img_dirs")
 @click.option("--machine_progress", is_flag=True, default=False, help="Print machine-readable progress lines instead of a progress bar")
-def main(img_dirs: str, size: str, workers: str, only_images: bool, recursive: bool, machine_progress: bool) -> None:
+def main(img_dirs: str, sizes: Tuple[str, ...], backend: str, workers: int, only_images: bool, files: Tuple[str, ...], recursive: bool, rescan: bool, retry_failed: bool, watch: bool, debounce: float, use_queue: bool, background_priority: float, machine_progress: bool) -> None:
     img_dirs = [Path(img_dir) for img_dir in img_dirs.split()]
-    global factory
-    factory = GnomeDesktop.DesktopThumbnailFactory.new(thumbnail_size_map[size])
+    backend = resolve_backend(backend)
+    if use_queue:
+        serve_queue(dir_paths=img_dirs, sizes=sizes, backend=backend, workers=workers, only_images=only_images, recursive=recursive, machine_progress=machine_progress, background_priority=background_priority, retry_failed=retry_failed)
+        return
+    if files:
+        sys.exit(0 if thumbnail_files(fpaths=files, sizes=sizes, backend=backend, workers=workers) else 1)
+    if not img_dirs:
+        raise click.UsageError("Missing option '-d' / '--img_dirs'")
+    if watch:
+        # Stopping the watcher must also take down the Pool of a batch in progress
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     for img_dir in img_dirs:
-        thumbnail_folder(dir_path=img_dir, workers=workers, only_images=only_images, recursive=recursive, machine_progress=machine_progress)
+        thumbnail_folder(dir_path=img_dir, sizes=sizes, backend=backend, workers=workers, only_images=only_images, recursive=recursive, machine_progress=machine_progress, use_manifest=not rescan, retry_failed=retry_failed)
     print("Thumbnail Generation Completed!")
+    if watch:
+        print("IDLE")
+        sys.stdout.flush()
+        try:
+            watch_folders(dir_paths=img_dirs, sizes=sizes, backend=backend, workers=workers, only_images=only_images, recursive=recursive, machine_progress=machine_progress, debounce=debounce)
+        except KeyboardInterrupt:
+            pass
 
 
 if __name__ == "__main__":
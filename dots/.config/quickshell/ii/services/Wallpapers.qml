@@ -16,7 +16,6 @@ Singleton {
     id: root
 
     property string thumbgenScriptPath: `${FileUtils.trimFileProtocol(Directories.scriptPath)}/thumbnails/thumbgen-venv.sh`
-    property string generateThumbnailsMagickScriptPath: `${FileUtils.trimFileProtocol(Directories.scriptPath)}/thumbnails/generate-thumbnails-magick.sh`
     property alias directory: folderModel.folder
     readonly property string effectiveDirectory: FileUtils.trimFileProtocol(folderModel.folder.toString())
     property url defaultFolder: Qt.resolvedUrl(`${Directories.pictures}/Wallpapers`)
@@ -26,7 +25,9 @@ Singleton {
         "jpg", "jpeg", "png", "webp", "avif", "bmp", "svg"
     ]
     property list<string> wallpapers: [] // List of absolute file paths (without file://)
-    readonly property bool thumbnailGenerationRunning: thumbgenProc.running
+    // The generator keeps watching the directory after its first pass, so "running" means it has work in flight
+    property bool thumbnailGenerationBusy: false
+    readonly property bool thumbnailGenerationRunning: thumbgenProc.running && thumbnailGenerationBusy
     property real thumbnailGenerationProgress: 0
 
     signal changed()
@@ -179,15 +180,20 @@ Singleton {
 
     // Thumbnail generation
     function generateThumbnail(size: string) {
-        if (!["normal", "large", "x-large", "xx-large"].includes(size)) throw new Error("Invalid thumbnail size");
+        const sizeNames = Object.keys(Images.thumbnailSizes);
+        if (!sizeNames.includes(size)) throw new Error("Invalid thumbnail size");
+        // Smaller sizes come from the same decode, so shrinking the grid later needs no regeneration
+        const sizeArgs = sizeNames.filter(s => Images.thumbnailSizes[s] <= Images.thumbnailSizes[size]).flatMap(s => ["--size", s])
         thumbgenProc.directory = root.directory
         thumbgenProc.running = false
+        // No shell in between: stopping the process must stop the watcher itself (the wrapper execs it).
+        // The backend defaults to auto, which already falls back to pillow
         thumbgenProc.command = [
-            "bash", "-c",
-            `${thumbgenScriptPath} --size ${size} --machine_progress -d ${FileUtils.trimFileProtocol(root.directory)} || ${generateThumbnailsMagickScriptPath} --size ${size} -d ${FileUtils.trimFileProtocol(root.directory)}`,
+            thumbgenScriptPath, ...sizeArgs, "--watch", "--machine_progress", "-d", FileUtils.trimFileProtocol(root.directory),
         ]
         // console.log("[Wallpapers] Updating thumbnails with command ", thumbgenProc.command.join(" "))
         root.thumbnailGenerationProgress = 0
+        root.thumbnailGenerationBusy = true
         thumbgenProc.running = true
     }
     Process {
@@ -196,21 +202,26 @@ Singleton {
         stdout: SplitParser {
             onRead: data => {
                 // print("thumb gen proc:", data)
-                let match = data.match(/PROGRESS (\d+)\/(\d+)/)
-                if (match) {
-                    const completed = parseInt(match[1])
-                    const total = parseInt(match[2])
-                    root.thumbnailGenerationProgress = completed / total
+                if (data === "IDLE") {
+                    // A pass (initial or after file changes) is done, the process keeps watching
+                    root.thumbnailGenerationBusy = false
+                    root.thumbnailGenerationProgress = 0
+                    root.thumbnailGenerated(thumbgenProc.directory)
+                    return
                 }
-                match = data.match(/FILE (.+)/)
-                if (match) {
-                    const filePath = match[1]
+                if (!data.startsWith("{")) return
+                // Batched progress: counts so far plus the files generated since the previous line
+                const progress = JSON.parse(data)
+                root.thumbnailGenerationProgress = progress.total > 0 ? progress.completed / progress.total : 0
+                root.thumbnailGenerationBusy = true
+                for (const filePath of progress.generated) {
                     root.thumbnailGeneratedFile(filePath)
                 }
             }
         }
         onExited: (exitCode, exitStatus) => {
             // print("[Wallpapers] Thumbnail generation completed with exit code", exitCode)
+            root.thumbnailGenerationBusy = false
             root.thumbnailGenerated(thumbgenProc.directory)
         }
     }